@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging as log
+from collections import deque
+
+import zmq
+import zmq.asyncio
+
+from spark.utils import compress
+from spark.connection import (
+    BROKER_REPLY_OK,
+    RESPONSE_WAIT_TIME,
+    ReplyException,
+    decode_reply,
+    new_job_request,
+    setup_curve_auth,
+    check_server_error,
+)
+from spark.utils.misc import to_compact_json
+
+
+class AsyncServerConnection:
+    """
+    Connection to a Lighthouse server for use with asyncio.
+
+    Unlike :class:`spark.connection.ServerConnection`, multiple requests can be
+    in flight at the same time, each one with its own timeout. Requests can be
+    cancelled by cancelling the task awaiting them.
+
+    If :broker_endpoint is set, requests are tagged with an ID and sent through the
+    local broker of the daemon. Otherwise we talk to the server directly, which
+    answers our requests in order, so replies are matched to requests by their
+    position. As a consequence, a request timing out in direct mode means we can
+    no longer trust the order, and all other pending requests fail as well.
+    """
+
+    def __init__(self, conf, ctx: zmq.asyncio.Context | None = None, broker_endpoint=None):
+        if zmq.zmq_version_info() < (4, 0):
+            raise RuntimeError(
+                "Security is not supported in libzmq version < 4.0. libzmq version {0}".format(
+                    zmq.zmq_version()
+                )
+            )
+        self._conf = conf
+        self._zctx = ctx if ctx else zmq.asyncio.Context.instance()
+        self._broker_endpoint = broker_endpoint
+        self._base_req: dict = {}
+        self._sock = None
+        self._reader: asyncio.Task | None = None
+
+        self._request_id = 0
+        # pending requests, by request ID in broker mode and in sending order otherwise
+        self._pending_ids: dict[bytes, asyncio.Future] = {}
+        self._pending_fifo: deque[asyncio.Future] = deque()
+
+    async def connect(self):
+        """
+        Set up the connection to the Lighthouse server or the local broker.
+        Must be called from within the event loop the connection is used in.
+        """
+        self._base_req = {}
+        self._base_req['machine_name'] = self._conf.machine_name
+        self._base_req['machine_id'] = self._conf.client_uuid
+        self._base_req['compression'] = compress.supported_methods()
+
+        self._open_socket()
+
+    def _open_socket(self):
+        self._sock = self._zctx.socket(zmq.DEALER)
+        self._sock.setsockopt(zmq.LINGER, 0)
+        if self._broker_endpoint:
+            self._sock.connect(self._broker_endpoint)
+        else:
+            setup_curve_auth(self._sock, self._conf)
+            self._sock.connect(self._conf.lighthouse_server)
+        self._reader = asyncio.create_task(self._read_replies())
+
+    def _close_socket(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _fail_pending(self, error: Exception):
+        for future in list(self._pending_ids.values()) + list(self._pending_fifo):
+            if not future.done():
+                future.set_exception(error)
+        self._pending_ids.clear()
+        self._pending_fifo.clear()
+
+    def _reset(self, reason: str):
+        log.warning('%s, reconnecting...', reason)
+        self._close_socket()
+        self._fail_pending(ReplyException(reason))
+        self._open_socket()
+
+    async def _read_replies(self):
+        while True:
+            try:
+                frames = await self._sock.recv_multipart()
+            except zmq.error.ZMQError as e:
+                self._fail_pending(ReplyException('ZMQ error, unable to receive reply: ' + str(e)))
+                return
+            if frames and frames[0] == b'':
+                frames = frames[1:]
+            self._dispatch(frames)
+
+    def _dispatch(self, frames: list[bytes]):
+        if self._broker_endpoint:
+            if len(frames) < 2:
+                return
+            future = self._pending_ids.pop(frames[0], None)
+            if future is None or future.done():
+                # late reply to a request we already gave up on
+                return
+            if frames[1] != BROKER_REPLY_OK:
+                future.set_exception(
+                    ReplyException(
+                        'Request failed (the master server might be unreachable): {}'.format(
+                            str(frames[1], 'utf-8', 'replace')
+                        )
+                    )
+                )
+            else:
+                future.set_result(frames[2:])
+            return
+
+        if not self._pending_fifo:
+            log.debug('Discarding unexpected reply from server.')
+            return
+        # cancelled requests stay in the queue until their reply arrived, to keep the order intact
+        future = self._pending_fifo.popleft()
+        if not future.done():
+            future.set_result(frames)
+
+    async def request(self, data: str | bytes, what: str = 'request', timeout: float | None = None):
+        """
+        Send a raw message and wait up to :timeout seconds for the reply frames.
+        """
+        if self._sock is None:
+            raise ReplyException('Not connected.')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if timeout is None:
+            timeout = RESPONSE_WAIT_TIME / 1000
+
+        future = asyncio.get_running_loop().create_future()
+        rid = b''
+        if self._broker_endpoint:
+            self._request_id += 1
+            rid = str(self._request_id).encode('ascii')
+            self._pending_ids[rid] = future
+            frames = [b'', rid, data]
+        else:
+            self._pending_fifo.append(future)
+            frames = [b'', data]
+
+        try:
+            await self._sock.send_multipart(frames)
+        except zmq.error.ZMQError as e:
+            # no reply will arrive for this message
+            self._pending_ids.pop(rid, None)
+            if future in self._pending_fifo:
+                self._pending_fifo.remove(future)
+            raise ReplyException('ZMQ error while sending {}: {}'.format(what, str(e))) from e
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as e:
+            if self._broker_endpoint:
+                self._pending_ids.pop(rid, None)
+            else:
+                self._reset('Request for {} expired'.format(what))
+            raise ReplyException(
+                'Request for {} expired (the master server might be unreachable).'.format(what)
+            ) from e
+        finally:
+            if self._broker_endpoint and future.cancelled():
+                self._pending_ids.pop(rid, None)
+
+    async def _request(self, req, what: str, timeout: float | None = None):
+        return await self.request(to_compact_json(req), what, timeout)
+
+    def new_base_request(self):
+        """
+        Get a copy of the base request template.
+        """
+        return dict(self._base_req)
+
+    async def send_job_status(self, job_id, status, timeout: float | None = None):
+        req = self.new_base_request()
+
+        req['request'] = 'job-{}'.format(status)
+        req['uuid'] = job_id
+
+        try:
+            await self._request(req, 'job status', timeout)
+        except ReplyException as e:
+            log.error('Unable to send job status: %s', str(e))
+
+    async def request_job(self, timeout: float | None = None):
+        """
+        Request a new job from the server.
+        """
+        req = new_job_request(self._base_req, self._conf)
+        job_reply = decode_reply(await self._request(req, 'job', timeout))
+        if not job_reply:
+            log.debug('No new jobs.')
+            return None
+        check_server_error(job_reply)
+
+        return job_reply
+
+    async def request_archive_info(self, timeout: float | None = None):
+        """
+        Request archive setup information, to know which repositories exist and where to upload to.
+        """
+        req = self.new_base_request()
+        req['request'] = 'archive-info'
+
+        reply_data = decode_reply(await self._request(req, 'archive data', timeout))
+        if not reply_data:
+            log.debug('No archive data configured.')
+            return None
+        check_server_error(reply_data)
+
+        return reply_data
+
+    async def close(self):
+        """Close the connection, failing all requests which are still pending."""
+        self._close_socket()
+        self._fail_pending(ReplyException('Connection was closed.'))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import logging as log
+from collections import deque
+
+import zmq
+
+from spark.connection import BROKER_REPLY_OK, RESPONSE_WAIT_TIME, setup_curve_auth
+
+# requests whose replies do not depend on the sender, so concurrent identical
+# requests can be answered with a single reply from the server
+COALESCABLE_REQUESTS = (b'"request":"archive-info"',)
+
+
+class _PendingRequest:
+    __slots__ = ('waiters', 'key', 'sent_time')
+
+    def __init__(self, waiters, key, sent_time):
+        self.waiters = waiters
+        self.key = key
+        self.sent_time = sent_time
+
+
+class LighthouseBroker:
+    """
+    Relay the traffic of all local worker processes through a single
+    encrypted connection to the Lighthouse server.
+
+    Workers talk to a ROUTER socket over IPC using DEALER sockets, sending
+    ``['', request-id, message]`` and receiving ``['', request-id, status, reply...]``.
+    Requests are pipelined to the server over one DEALER socket and the server's
+    replies, which arrive in order, are matched to the waiting workers.
+    """
+
+    # interval (in seconds) to log connection statistics in
+    STATS_INTERVAL = 600
+
+    def __init__(self, conf, ctx, endpoint: str):
+        self._conf = conf
+        self._zctx = ctx
+        self._endpoint = endpoint
+        self._pending: deque[_PendingRequest] = deque()
+        self._inflight_keys: dict[bytes, _PendingRequest] = {}
+        self._upstream = None
+
+        self._stats = {
+            'requests': 0,
+            'replies': 0,
+            'coalesced': 0,
+            'timeouts': 0,
+            'reconnects': 0,
+            'max_in_flight': 0,
+        }
+        self._last_stats_time = time.monotonic()
+
+    def _connect_upstream(self):
+        if self._upstream is not None:
+            self._poller.unregister(self._upstream)
+            self._upstream.close()
+        self._upstream = self._zctx.socket(zmq.DEALER)
+        self._upstream.setsockopt(zmq.LINGER, 0)
+        setup_curve_auth(self._upstream, self._conf)
+        self._upstream.connect(self._conf.lighthouse_server)
+        self._poller.register(self._upstream, zmq.POLLIN)
+
+    def _reply(self, waiters, frames: list[bytes]):
+        for ident, rid in waiters:
+            self._frontend.send_multipart([ident, b'', rid] + frames)
+
+    def _handle_frontend(self):
+        frames = self._frontend.recv_multipart()
+        if len(frames) < 4 or frames[1] != b'':
+            log.warning('Broker: Dropping malformed message from worker.')
+            return
+        ident, rid, payload = frames[0], frames[2], frames[3:]
+        self._stats['requests'] += 1
+
+        key = None
+        if len(payload) == 1 and any(r in payload[0] for r in COALESCABLE_REQUESTS):
+            key = payload[0]
+            pending = self._inflight_keys.get(key)
+            if pending is not None:
+                pending.waiters.append((ident, rid))
+                self._stats['coalesced'] += 1
+                return
+
+        self._upstream.send_multipart([b''] + payload)
+        pending = _PendingRequest([(ident, rid)], key, time.monotonic())
+        self._pending.append(pending)
+        if key is not None:
+            self._inflight_keys[key] = pending
+        self._stats['max_in_flight'] = max(self._stats['max_in_flight'], len(self._pending))
+
+    def _handle_upstream(self):
+        frames = self._upstream.recv_multipart()
+        if frames and frames[0] == b'':
+            frames = frames[1:]
+        if not self._pending:
+            log.debug('Broker: Discarding unexpected reply from server.')
+            return
+        pending = self._pending.popleft()
+        if pending.key is not None:
+            self._inflight_keys.pop(pending.key, None)
+        self._stats['replies'] += 1
+        self._reply(pending.waiters, [BROKER_REPLY_OK] + frames)
+
+    def _check_timeouts(self):
+        if not self._pending:
+            return
+        if time.monotonic() - self._pending[0].sent_time < RESPONSE_WAIT_TIME / 1000:
+            return
+
+        # replies are matched by their order, so once one is missing we can not
+        # trust any of the others - fail all pending requests and start over
+        log.warning(
+            'Broker: No reply from master for %d pending request(s), reconnecting.',
+            len(self._pending),
+        )
+        self._stats['timeouts'] += len(self._pending)
+        self._stats['reconnects'] += 1
+        for pending in self._pending:
+            self._reply(pending.waiters, [b'timeout'])
+        self._pending.clear()
+        self._inflight_keys.clear()
+        self._connect_upstream()
+
+    def _log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats_time < self.STATS_INTERVAL:
+            return
+        self._last_stats_time = now
+        log.info(
+            'Broker statistics: %s',
+            ', '.join('{}={}'.format(k, v) for k, v in self._stats.items()),
+        )
+
+    def stats(self) -> dict[str, int]:
+        return dict(self._stats)
+
+    def run(self):
+        self._frontend = self._zctx.socket(zmq.ROUTER)
+        self._frontend.setsockopt(zmq.LINGER, 0)
+        self._frontend.bind(self._endpoint)
+
+        self._poller = zmq.Poller()
+        self._poller.register(self._frontend, zmq.POLLIN)
+        self._connect_upstream()
+        log.info('Relaying Lighthouse connections of workers via %s', self._endpoint)
+
+        while True:
+            sev = dict(self._poller.poll(1000))
+            if sev.get(self._upstream) == zmq.POLLIN:
+                self._handle_upstream()
+            if sev.get(self._frontend) == zmq.POLLIN:
+                self._handle_frontend()
+            self._check_timeouts()
+            self._log_stats()
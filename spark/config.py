@@ -73,10 +73,28 @@ class LocalConfig:
                 'Please specify the address of a Lighthouse server.'
             )
 
+        # optional endpoint the server publishes "new jobs available" notifications on
+        self._job_notify_server = cdata.get('JobNotifyServer')
+        self._job_notify_topic = cdata.get('JobNotifyTopic', '_lk.jobs.')
+
         self._max_jobs = int(cdata.get("MaxJobs", 1))
         if self._max_jobs < 1:
             raise ConfigError('The maximum number of jobs can not be < 1.')
 
+        # optionally, workers only take another job while the machine has resources left
+        self._admission_max_load = float(cdata.get('AdmissionMaxLoadPerCPU', 0))
+        self._admission_min_free_memory = int(
+            float(cdata.get('AdmissionMinFreeMemoryGiB', 0)) * 1024**3
+        )
+        self._admission_max_memory_pressure = float(cdata.get('AdmissionMaxMemoryPressure', 0))
+        self._admission_min_free_disk = int(
+            float(cdata.get('AdmissionMinFreeDiskGiB', 0)) * 1024**3
+        )
+        self._admission_cooldown = float(cdata.get('AdmissionCooldown', 30))
+
+        # with multiple job slots, every slot gets its own share of the CPUs
+        self._partition_cpus = bool(cdata.get('PartitionCPUs', True))
+
         self._client_cert_fname = os.path.join(
             self.CERTS_BASE_DIR, 'secret', '{0}-spark_private.sec'.format(self.machine_name)
         )
@@ -87,9 +105,42 @@ class LocalConfig:
         workspace_root = cdata.get('WorkspaceRoot')
         if not workspace_root:
             workspace_root = '/var/lib/lkspark/'
+        self._workspace_root = workspace_root
         self._workspace_dir = os.path.join(workspace_root, 'workspaces')
         self._job_log_dir = os.path.join(workspace_root, 'logs')
         self._dput_cf_fname = os.path.join(workspace_root, 'dput.cf')
+        self._outbox_dir = os.path.join(workspace_root, 'outbox')
+        self._upload_spool_dir = os.path.join(workspace_root, 'uploads')
+        self._prefetch_dir = os.path.join(workspace_root, 'prefetch')
+        self._broker_endpoint = 'ipc://{}'.format(os.path.join(workspace_root, 'lighthouse.sock'))
+        self._digest_cache_fname = os.path.join(workspace_root, 'cache', 'digests.json')
+
+        self._source_cache_dir = os.path.join(workspace_root, 'cache', 'sources')
+        self._source_cache_max_bytes = int(float(cdata.get('SourceCacheSizeGiB', 20)) * 1024**3)
+
+        self._git_cache_dir = os.path.join(workspace_root, 'cache', 'git')
+        self._git_mirror_max_age = float(cdata.get('GitMirrorMaxAgeDays', 14)) * 24 * 3600
+
+        # removal of old workspaces in the background
+        self._reaper_threads = int(cdata.get('ReaperThreads', 4))
+        self._reaper_max_io_pressure = float(cdata.get('ReaperMaxIOPressure', 10))
+
+        self._digest_cache_entries = int(cdata.get('DigestCacheEntries', 4096))
+        if self._digest_cache_entries < 1:
+            raise ConfigError('The digest cache must be able to hold at least one entry.')
+
+        # status messages and log excerpts sent within a short time are batched into
+        # one multi-part message, if the server supports it
+        self._message_batch_size = int(cdata.get('MessageBatchSize', 1))
+        if self._message_batch_size < 1:
+            raise ConfigError('The message batch size can not be < 1.')
+        self._message_batch_delay = int(cdata.get('MessageBatchDelay', 50)) / 1000
+
+        # results of finished jobs are published in the background, within these limits
+        self._max_publishes = int(cdata.get('MaxPublishes', 2))
+        if self._max_publishes < 1:
+            raise ConfigError('The maximum number of publishes in flight can not be < 1.')
+        self._max_publish_bytes = int(float(cdata.get('MaxPublishDiskUsageGiB', 0)) * 1024**3)
 
         self._architectures = cdata.get("Architectures")
         if not self._architectures:
@@ -149,6 +200,14 @@ class LocalConfig:
     def lighthouse_server(self) -> str:
         return self._lighthouse_server
 
+    @property
+    def job_notify_server(self) -> str | None:
+        return self._job_notify_server
+
+    @property
+    def job_notify_topic(self) -> str:
+        return self._job_notify_topic
+
     @property
     def max_jobs(self) -> int:
         return self._max_jobs
@@ -161,6 +220,10 @@ class LocalConfig:
     def server_cert_fname(self) -> str:
         return self._server_cert_fname
 
+    @property
+    def workspace_root(self) -> str:
+        return self._workspace_root
+
     @property
     def workspace_dir(self) -> str:
         return self._workspace_dir
@@ -170,6 +233,118 @@ class LocalConfig:
         """Path to our dput.cf filename."""
         return self._dput_cf_fname
 
+    @property
+    def digest_cache_fname(self) -> str:
+        """Path to the persistent cache of artifact checksums."""
+        return self._digest_cache_fname
+
+    @property
+    def digest_cache_entries(self) -> int:
+        return self._digest_cache_entries
+
+    @property
+    def message_batch_size(self) -> int:
+        return self._message_batch_size
+
+    @property
+    def message_batch_delay(self) -> float:
+        """Time in seconds to wait for more messages before sending a batch."""
+        return self._message_batch_delay
+
+    @property
+    def outbox_dir(self) -> str:
+        """Directory for journals of messages not yet delivered to the server."""
+        return self._outbox_dir
+
+    @property
+    def upload_spool_dir(self) -> str:
+        """Directory holding artifacts of finished jobs until they are uploaded."""
+        return self._upload_spool_dir
+
+    @property
+    def max_publishes(self) -> int:
+        """Maximum number of finished jobs being published at the same time, per worker."""
+        return self._max_publishes
+
+    @property
+    def max_publish_bytes(self) -> int:
+        """Maximum size of artifacts being published or waiting for upload (0 = no limit)."""
+        return self._max_publish_bytes
+
+    @property
+    def prefetch_dir(self) -> str:
+        """Staging area for inputs of jobs which were downloaded ahead of time."""
+        return self._prefetch_dir
+
+    @property
+    def source_cache_dir(self) -> str:
+        return self._source_cache_dir
+
+    @property
+    def source_cache_max_bytes(self) -> int:
+        """Size limit of the source package cache (0 = caching disabled)."""
+        return self._source_cache_max_bytes
+
+    @property
+    def git_cache_dir(self) -> str:
+        return self._git_cache_dir
+
+    @property
+    def git_mirror_max_age(self) -> float:
+        """Time in seconds after which unused Git mirrors are removed (0 = no mirrors)."""
+        return self._git_mirror_max_age
+
+    @property
+    def reaper_threads(self) -> int:
+        return self._reaper_threads
+
+    @property
+    def reaper_max_io_pressure(self) -> float:
+        """I/O pressure (avg10 in percent) above which the workspace reaper slows down."""
+        return self._reaper_max_io_pressure
+
+    @property
+    def admission_enabled(self) -> bool:
+        """Whether any resource threshold for taking jobs is set."""
+        return (
+            self._admission_max_load > 0
+            or self._admission_min_free_memory > 0
+            or self._admission_max_memory_pressure > 0
+            or self._admission_min_free_disk > 0
+        )
+
+    @property
+    def admission_max_load(self) -> float:
+        """Load average per CPU above which no further job is taken (0 = no limit)."""
+        return self._admission_max_load
+
+    @property
+    def admission_min_free_memory(self) -> int:
+        return self._admission_min_free_memory
+
+    @property
+    def admission_max_memory_pressure(self) -> float:
+        """Memory pressure (avg10 in percent) above which no further job is taken (0 = no limit)."""
+        return self._admission_max_memory_pressure
+
+    @property
+    def admission_min_free_disk(self) -> int:
+        return self._admission_min_free_disk
+
+    @property
+    def admission_cooldown(self) -> float:
+        """Time in seconds to wait after starting a job before admitting another one."""
+        return self._admission_cooldown
+
+    @property
+    def partition_cpus(self) -> bool:
+        return self._partition_cpus
+
+    @property
+    def broker_endpoint(self) -> str:
+        """Local endpoint worker processes use to reach the Lighthouse server."""
+        return self._broker_endpoint
+
     @property
     def job_log_dir(self) -> str:
         return self._job_log_dir
@@ -19,12 +19,18 @@
 
 import os
 import json
+import time
 import logging as log
+import threading
 from enum import StrEnum
+from collections import deque
+from concurrent.futures import Future
 
 import zmq
 import zmq.auth
 
+from spark.utils import compress
+from spark.outbox import Outbox
 from spark.utils.misc import to_compact_json
 
 
@@ -52,9 +58,200 @@ class ServerErrorException(Exception):
 # maximum amount of time to wait for a server response
 RESPONSE_WAIT_TIME = 15000  # 15sec
 
+# additional time to wait for a reply from the local broker, which has its own timeout
+BROKER_GRACE_TIME = 5000  # 5sec
+
+# status frame of replies from the local broker for successful requests
+BROKER_REPLY_OK = b'ok'
+
+# maximum amount of time (in seconds) to wait for the reply to a request, including
+# the time it waits for other requests to be sent first
+REQUEST_TIMEOUT = 4 * (RESPONSE_WAIT_TIME + BROKER_GRACE_TIME) / 1000
+
+# control messages for the I/O thread
+_RECONNECT = object()
+_SHUTDOWN = object()
+
+
+class _SendQueue:
+    """
+    Messages waiting to be sent by the I/O thread.
+
+    Items are tuples of (data, future, what, batchable, noreply). Requests somebody
+    waits for are always sent before messages nobody waits for a reply to, and only
+    :noreply_limit of the latter are kept: once the limit is reached, the oldest
+    one is dropped.
+    """
+
+    def __init__(self, noreply_limit: int):
+        self._cond = threading.Condition()
+        self._requests: deque = deque()
+        self._noreply: deque = deque()
+        self._noreply_limit = noreply_limit
+        self._error: Exception | None = None
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._error is not None:
+                if item[1] is not None:
+                    item[1].set_exception(self._error)
+                return
+            if item[4]:
+                if len(self._noreply) >= self._noreply_limit:
+                    self._noreply.popleft()[1].cancel()
+                    self.dropped += 1
+                self._noreply.append(item)
+            else:
+                self._requests.append(item)
+            self._cond.notify()
+
+    def get(self, timeout: float | None = None):
+        """Get the next item to send, or None if there was none within :timeout seconds."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._requests or self._noreply, timeout):
+                return None
+            if self._requests:
+                return self._requests.popleft()
+            return self._noreply.popleft()
+
+    def drop_noreply(self) -> int:
+        """Drop all queued messages nobody waits for a reply to."""
+        with self._cond:
+            count = len(self._noreply)
+            while self._noreply:
+                self._noreply.popleft()[1].cancel()
+            self.dropped += count
+        return count
+
+    def close(self, error: Exception):
+        """Fail all queued and future requests with :error."""
+        with self._cond:
+            self._error = error
+            items = list(self._requests) + list(self._noreply)
+            self._requests.clear()
+            self._noreply.clear()
+        for item in items:
+            if item[1] is not None and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(error)
+
+
+def setup_curve_auth(sock, conf):
+    """Configure a socket to talk to the Lighthouse server using our CurveZMQ certificates."""
+
+    # set server certificate
+    server_public, _ = zmq.auth.load_certificate(conf.server_cert_fname)
+    sock.curve_serverkey = server_public
+
+    # set client certificate
+    client_secret_file = os.path.join(conf.client_cert_fname)
+    client_public, client_secret = zmq.auth.load_certificate(client_secret_file)
+    sock.curve_secretkey = client_secret
+    sock.curve_publickey = client_public
+
+
+def new_job_request(base_req: dict, conf, request: str = 'job') -> dict:
+    """Construct a request for new jobs, announcing what kind of jobs we accept."""
+    req = dict(base_req)
+    req['request'] = request
+    req['owner'] = conf.machine_owner
+    req['accepts'] = conf.accepted_job_kinds
+    req['architectures'] = conf.supported_architectures
+    return req
+
+
+def decode_reply(reply_msgs):
+    """Decode the JSON data of a server reply."""
+    if not reply_msgs:
+        raise ReplyException('Invalid server response on a job request.')
+    reply_raw = reply_msgs[0]
+
+    try:
+        return json.loads(str(reply_raw, 'utf-8'))
+    except Exception as e:
+        raise MessageException(
+            'Unable to decode server reply ({0}): {1}'.format(reply_raw, str(e))
+        ) from e
+
+
+def check_server_error(reply):
+    """Raise an exception if the server replied with an error message."""
+    try:
+        server_error = reply.get('error')
+    except Exception as e:
+        raise ServerErrorException('Received unexpected server reply: {}'.format(str(reply))) from e
+
+    if server_error:
+        raise ServerErrorException('Received error message from server: {}'.format(server_error))
+
+
+class JobNotifier:
+    """
+    Listen for notifications about newly available jobs published by the server,
+    so idle workers can ask for a job right away instead of waiting for their next poll.
+    """
 
-class ServerConnection:
     def __init__(self, conf, ctx):
+        self._sock = ctx.socket(zmq.SUB)
+        self._sock.setsockopt(zmq.LINGER, 0)
+        setup_curve_auth(self._sock, conf)
+        self._sock.setsockopt_string(zmq.SUBSCRIBE, conf.job_notify_topic)
+        self._sock.connect(conf.job_notify_server)
+
+        self._poller = zmq.Poller()
+        self._poller.register(self._sock, zmq.POLLIN)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait up to :timeout seconds for a notification.
+        Returns True if we were notified about new jobs.
+        """
+        try:
+            sev = dict(self._poller.poll(int(timeout * 1000)))
+        except zmq.error.ZMQError as e:
+            log.warning('ZMQ error while waiting for job notifications: %s', str(e))
+            time.sleep(timeout)
+            return False
+        if sev.get(self._sock) != zmq.POLLIN:
+            return False
+
+        # a burst of notifications only needs to wake us up once
+        while True:
+            try:
+                self._sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+        return True
+
+
+class ServerConnection:
+    """
+    Connection to a Lighthouse server.
+
+    ZeroMQ sockets must not be shared between threads, so a single I/O thread owns
+    the socket and processes all requests in the order they were submitted.
+    Callers receive a :class:`concurrent.futures.Future` for every request.
+
+    If :broker_endpoint is set, requests are sent through the local broker of the
+    daemon (see :class:`spark.broker.LighthouseBroker`) instead of connecting to
+    the server directly.
+
+    If :outbox_fname is set, job status changes and final log excerpts are recorded
+    in a durable :class:`spark.outbox.Outbox` and delivered in the background.
+
+    Status updates and log excerpts can be batched: if enabled in the configuration,
+    such messages which are queued at about the same time are sent together as one
+    multi-part message, and the server replies with one frame per part.
+    """
+
+    # time (in seconds) to wait for queued messages to be delivered when closing
+    OUTBOX_CLOSE_TIMEOUT = 30
+
+    # maximum number of messages nobody waits for a reply to (like intermediate log
+    # excerpts) which are queued for sending, older ones are dropped
+    NOREPLY_BACKLOG = 32
+
+    def __init__(self, conf, ctx, broker_endpoint=None, outbox_fname=None):
         if zmq.zmq_version_info() < (4, 0):
             raise RuntimeError(
                 "Security is not supported in libzmq version < 4.0. libzmq version {0}".format(
@@ -65,6 +262,23 @@ class ServerConnection:
         self._zctx = ctx
 
         self._send_attempts = 0
+        self._batch_requests = True
+        self._broker_endpoint = broker_endpoint
+        self._request_id = 0
+        self._sock = None
+        self._queue = _SendQueue(self.NOREPLY_BACKLOG)
+        self._io_thread: threading.Thread | None = None
+        self._outbox_fname = outbox_fname
+        self._outbox: Outbox | None = None
+        self._status_lock = threading.Lock()
+        self._status_seqs: dict[str, int] = {}
+
+        # batching of status messages
+        self._batch_size = conf.message_batch_size
+        self._batch_delay = conf.message_batch_delay
+        self._frames_sent = 0
+        self._messages_sent = 0
+        self._max_batch = 0
 
     def connect(self):
         """
@@ -76,20 +290,36 @@ class ServerConnection:
         self._base_req = {}
         self._base_req['machine_name'] = self._conf.machine_name
         self._base_req['machine_id'] = self._conf.client_uuid
+        # compression methods we can use for log excerpts, the server selects one
+        # when assigning a job to us
+        self._base_req['compression'] = compress.supported_methods()
+
+        if self._io_thread is None:
+            # open the socket here, so configuration errors are raised to the caller
+            self._open_socket()
+            self._io_thread = threading.Thread(
+                target=self._io_loop, name='lighthouse-io', daemon=True
+            )
+            self._io_thread.start()
+        if self._outbox_fname and self._outbox is None:
+            self._outbox = Outbox(self, self._outbox_fname)
+
+    def _open_socket(self):
+        if self._broker_endpoint:
+            # requests are relayed by the local broker, which talks to the server for us
+            self._sock = self._zctx.socket(zmq.DEALER)
+            self._sock.setsockopt(zmq.LINGER, 0)
+            self._sock.connect(self._broker_endpoint)
+            self._poller = zmq.Poller()
+            self._poller.register(self._sock, zmq.POLLIN)
+            return
 
         # initialize Lighthouse socket
         self._sock = self._zctx.socket(zmq.REQ)
         self._sock.setsockopt(zmq.REQ_RELAXED, 1)
-
-        # set server certificate
-        server_public, _ = zmq.auth.load_certificate(self._conf.server_cert_fname)
-        self._sock.curve_serverkey = server_public
-
-        # set client certificate
-        client_secret_file = os.path.join(self._conf.client_cert_fname)
-        client_public, client_secret = zmq.auth.load_certificate(client_secret_file)
-        self._sock.curve_secretkey = client_secret
-        self._sock.curve_publickey = client_public
+        self._sock.setsockopt(zmq.REQ_CORRELATE, 1)
+        self._sock.setsockopt(zmq.LINGER, 0)
+        setup_curve_auth(self._sock, self._conf)
 
         # connect
         self._sock.connect(self._conf.lighthouse_server)
@@ -97,37 +327,243 @@ class ServerConnection:
         self._poller = zmq.Poller()
         self._poller.register(self._sock, zmq.POLLIN)
 
+    def _reconnect(self):
+        self._sock.close()
+        self._open_socket()
+
     def reconnect(self):
         """
         Re-establish connection. The lazy answer in case we got
         no reply from the server for a while.
         """
-        self._sock.close()
-        self.connect()
-
-    def send_job_status(self, job_id, status):
-        req = self.new_base_request()
+        self._queue.put((_RECONNECT, None, None, False, False))
+
+    def close(self):
+        """Stop the I/O thread once all pending requests were processed."""
+        if self._outbox is not None:
+            self._outbox.close(self.OUTBOX_CLOSE_TIMEOUT)
+            self._outbox = None
+        if self._io_thread is None:
+            return
+        self._queue.put((_SHUTDOWN, None, None, False, False))
+        self._io_thread.join()
+        self._io_thread = None
+
+    def _io_loop(self):
+        error = ReplyException('The connection to the server was closed.')
+        item = None
+        try:
+            while True:
+                if item is None:
+                    item = self._queue.get()
+                    if item is None:
+                        continue
+                if item[0] is _SHUTDOWN:
+                    break
+                if item[0] is _RECONNECT:
+                    item = None
+                    self._reconnect()
+                    continue
+                if item[3] and self._batch_size > 1:
+                    batch, item = self._collect_batch(item)
+                    self._send_batch(batch)
+                    continue
+                batch, item = [item], None
+                self._send_batch(batch)
+        except Exception as e:
+            log.error('Lighthouse connection failed: %s', str(e))
+            error = ReplyException('The connection to the server failed: {}'.format(str(e)))
+        finally:
+            # nobody must wait for requests which will never be sent
+            self._queue.close(error)
+            if item is not None and item[1] is not None:
+                if item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(error)
+            if self._sock is not None:
+                self._sock.close()
+
+    def _collect_batch(self, first):
+        """
+        Collect batchable messages until the batch is full or the flush deadline passed.
+        Returns the batch, and the next queued item if it could not be added to the batch.
+        """
+        batch = [first]
+        deadline = time.monotonic() + self._batch_delay
+        while len(batch) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            item = self._queue.get(timeout=remaining)
+            if item is None:
+                break
+            if not item[3]:
+                # sent after the batch, to keep messages in order
+                return batch, item
+            batch.append(item)
+        return batch, None
+
+    def _send_batch(self, batch):
+        batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        if len(batch) == 1:
+            what = batch[0][2]
+        else:
+            what = 'batch of {} messages'.format(len(batch))
+        frames = [entry[0] for entry in batch]
 
-        req['request'] = 'job-{}'.format(status)
-        req['uuid'] = job_id
+        try:
+            reply = self._exchange(frames, what)
+        except Exception as e:
+            for entry in batch:
+                entry[1].set_exception(e)
+            if any(entry[4] for entry in batch):
+                # the server is likely unreachable, and the other queued messages nobody
+                # waits for would only hold up requests while waiting for their timeout
+                dropped = self._queue.drop_noreply()
+                if dropped:
+                    log.info('Dropped %d queued noreply message(s).', dropped)
+            return
+
+        self._frames_sent += 1
+        self._messages_sent += len(batch)
+        self._max_batch = max(self._max_batch, len(batch))
+        if len(batch) == 1:
+            batch[0][1].set_result(reply)
+            return
+        for i, (_, future, _, _, _) in enumerate(batch):
+            # the server sends one reply per message, or one for the whole batch
+            future.set_result([reply[i]] if len(reply) == len(batch) else reply)
+
+    def message_stats(self) -> dict[str, float]:
+        """Statistics on messages sent to the server."""
+        return {
+            'frames': self._frames_sent,
+            'messages': self._messages_sent,
+            'messages_per_frame': self._messages_sent / max(self._frames_sent, 1),
+            'max_batch': self._max_batch,
+            'noreply_dropped': self._queue.dropped,
+        }
+
+    def _exchange_broker(self, frames: list[bytes], what: str):
+        self._request_id += 1
+        rid = str(self._request_id).encode('ascii')
+        try:
+            self._sock.send_multipart([b'', rid] + frames)
+        except zmq.error.ZMQError as e:
+            raise ReplyException('ZMQ error while sending {}: {}'.format(what, str(e))) from e
+
+        # the broker reports a timeout itself, we only wait a bit longer in case it is stuck
+        deadline = time.monotonic() + (RESPONSE_WAIT_TIME + BROKER_GRACE_TIME) / 1000
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ReplyException(
+                    'Request for {} expired (the broker did not reply).'.format(what)
+                )
+            try:
+                sev = dict(self._poller.poll(int(remaining * 1000) + 1))
+            except zmq.error.ZMQError as e:
+                raise ReplyException('ZMQ error while polling for reply: ' + str(e)) from e
+            if sev.get(self._sock) != zmq.POLLIN:
+                continue
+            frames = self._sock.recv_multipart()
+            if len(frames) < 3 or frames[1] != rid:
+                # late reply to a request we already gave up on
+                continue
+            if frames[2] != BROKER_REPLY_OK:
+                raise ReplyException(
+                    'Request for {} failed (the master server might be unreachable): {}'.format(
+                        what, str(frames[2], 'utf-8', 'replace')
+                    )
+                )
+            return frames[3:]
 
+    def _exchange(self, frames: list[bytes], what: str):
+        """Send a message and wait for its reply. Only ever called in the I/O thread."""
+        if self._broker_endpoint:
+            return self._exchange_broker(frames, what)
         try:
-            self._sock.send_string(to_compact_json(req))
+            self._sock.send_multipart(frames)
         except zmq.error.ZMQError as e:
             self._send_attempt_failed(e)
-            log.error('ZMQ error while sending job status: %s', str(e))
+            raise ReplyException('ZMQ error while sending {}: {}'.format(what, str(e))) from e
+
         try:
-            sockev = dict(self._poller.poll(RESPONSE_WAIT_TIME))
+            sev = dict(self._poller.poll(RESPONSE_WAIT_TIME))
         except zmq.error.ZMQError as e:
+            self._send_attempt_failed(e)
+            raise ReplyException('ZMQ error while polling for reply: ' + str(e)) from e
+
+        if sev.get(self._sock) != zmq.POLLIN:
             self._send_attempt_failed()
-            log.error('ZMQ error while waiting for reply: %s', str(e))
-        if sockev.get(self._sock) == zmq.POLLIN:
-            try:
-                self._sock.recv_multipart()  # discard reply
-            except zmq.error.ZMQError as e:
-                log.error('ZMQ error, unable to receive reply: %s', str(e))
-        else:
-            log.error('Unable to send job status: No reply from master')
+            raise ReplyException(
+                'Request for {} expired (the master server might be unreachable).'.format(what)
+            )
+        try:
+            reply_msgs = self._sock.recv_multipart()
+        except zmq.error.ZMQError as e:
+            raise ReplyException('ZMQ error, unable to receive reply: ' + str(e)) from e
+        self._send_attempts = 0
+
+        return reply_msgs
+
+    def submit(
+        self,
+        data: str | bytes,
+        what: str = 'request',
+        batchable: bool = False,
+        noreply: bool = False,
+    ) -> Future:
+        """
+        Queue a raw message for sending to the server.
+        The returned future resolves to the reply frames.
+        If :batchable is set, the message may be sent together with others.
+        If :noreply is set, nobody waits for the reply: the message is sent after all
+        other requests, and may be dropped if too many such messages are queued.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        future: Future = Future()
+        self._queue.put((data, future, what, batchable, noreply))
+        return future
+
+    def _request(self, req, what: str, batchable: bool = False):
+        future = self.submit(to_compact_json(req), what, batchable)
+        try:
+            return future.result(timeout=REQUEST_TIMEOUT)
+        except TimeoutError as e:
+            future.cancel()
+            raise ReplyException('Request for {} timed out.'.format(what)) from e
+
+    def send_job_status(self, job_id, status):
+        req = self.new_base_request()
+
+        req['request'] = 'job-{}'.format(status)
+        req['uuid'] = job_id
+
+        if self._outbox is not None:
+            seq = self._outbox.post(to_compact_json(req), 'job status')
+            with self._status_lock:
+                outbox = self._outbox
+                self._status_seqs = {
+                    j: s for j, s in self._status_seqs.items() if not outbox.delivered(s)
+                }
+                self._status_seqs[job_id] = seq
+            return
+        try:
+            self._request(req, 'job status', batchable=True)
+        except ReplyException as e:
+            log.error('Unable to send job status: %s', str(e))
+
+    def job_status_delivered(self, job_id) -> bool:
+        """Whether the last status update of job :job_id reached the server."""
+        with self._status_lock:
+            seq = self._status_seqs.get(job_id)
+            if seq is None or self._outbox is None or self._outbox.delivered(seq):
+                self._status_seqs.pop(job_id, None)
+                return True
+        return False
 
     def new_base_request(self):
         """
@@ -140,58 +576,47 @@ class ServerConnection:
         Request a new job from the server.
         """
 
-        # construct job request
-        req = dict(self._base_req)
-        req['request'] = 'job'
-        req['owner'] = self._conf.machine_owner
-        req['accepts'] = self._conf.accepted_job_kinds
-        req['architectures'] = self._conf.supported_architectures
-
         # request job
-        self._sock.send_string(to_compact_json(req))
-
-        # wait for a reply
-        job_reply_msgs = None
-        try:
-            sev = dict(self._poller.poll(RESPONSE_WAIT_TIME))
-        except zmq.error.ZMQError as e:
-            self._send_attempt_failed()
-            raise ReplyException('ZMQ error while polling for reply: ' + str(e)) from e
-
-        if sev.get(self._sock) == zmq.POLLIN:
-            job_reply_msgs = self._sock.recv_multipart()
-        else:
-            self._send_attempt_failed()
-            raise ReplyException('Job request expired (the master server might be unreachable).')
-
-        if not job_reply_msgs:
-            raise ReplyException('Invalid server response on a job request.')
-        job_reply_raw = job_reply_msgs[0]
-
-        job_reply = None
-        try:
-            job_reply = json.loads(str(job_reply_raw, 'utf-8'))
-        except Exception as e:
-            raise MessageException(
-                'Unable to decode server reply ({0}): {1}'.format(job_reply_raw, str(e))
-            ) from e
+        req = new_job_request(self._base_req, self._conf)
+        job_reply = decode_reply(self._request(req, 'job'))
         if not job_reply:
             log.debug('No new jobs.')
             return None
+        check_server_error(job_reply)
 
-        try:
-            server_error = job_reply.get('error')
-        except Exception as e:
-            raise ServerErrorException(
-                'Received unexpected server reply: {}'.format(str(job_reply))
-            ) from e
+        return job_reply
 
-        if server_error:
-            raise ServerErrorException(
-                'Received error message from server: {}'.format(server_error)
-            )
+    def request_jobs(self, limit: int) -> list[dict]:
+        """
+        Request up to :limit jobs from the server at once.
+        Falls back to requesting a single job if the server does not support this.
+        """
+        if limit <= 1 or not self._batch_requests:
+            job = self.request_job()
+            return [job] if job else []
+
+        # request jobs
+        req = new_job_request(self._base_req, self._conf, 'jobs')
+        req['limit'] = limit
+        reply = decode_reply(self._request(req, 'jobs'))
+        if not reply:
+            log.debug('No new jobs.')
+            return []
+
+        if isinstance(reply, dict):
+            if reply.get('error'):
+                # the server likely does not know about batched requests
+                log.info(
+                    'Server refused batched job request (%s), requesting jobs one by one.',
+                    reply.get('error'),
+                )
+                self._batch_requests = False
+                return self.request_jobs(1)
+            return [reply]
+        if not isinstance(reply, list):
+            raise ServerErrorException('Received unexpected server reply: {}'.format(str(reply)))
 
-        return job_reply
+        return [job for job in reply if job]
 
     def request_archive_info(self):
         """
@@ -203,50 +628,11 @@ class ServerConnection:
         req['request'] = 'archive-info'
 
         # request data
-        self._sock.send_string(to_compact_json(req))
-
-        # wait for a reply
-        reply_msgs = None
-        try:
-            sev = dict(self._poller.poll(RESPONSE_WAIT_TIME))
-        except zmq.error.ZMQError as e:
-            self._send_attempt_failed()
-            raise ReplyException('ZMQ error while polling for setup data reply: ' + str(e)) from e
-
-        if sev.get(self._sock) == zmq.POLLIN:
-            reply_msgs = self._sock.recv_multipart()
-        else:
-            self._send_attempt_failed()
-            raise ReplyException(
-                'Request for archive data expired (the master server might be unreachable).'
-            )
-
-        if not reply_msgs:
-            raise ReplyException('Invalid server response on a job request.')
-        reply_raw = reply_msgs[0]
-
-        reply_data = None
-        try:
-            reply_data = json.loads(str(reply_raw, 'utf-8'))
-        except Exception as e:
-            raise MessageException(
-                'Unable to decode server reply ({0}): {1}'.format(reply_raw, str(e))
-            ) from e
+        reply_data = decode_reply(self._request(req, 'archive data'))
         if not reply_data:
             log.debug('No archive data configured.')
             return None
-
-        try:
-            server_error = reply_data.get('error')
-        except Exception as e:
-            raise ServerErrorException(
-                'Received unexpected server reply: {}'.format(str(reply_data))
-            ) from e
-
-        if server_error:
-            raise ServerErrorException(
-                'Received error message from server: {}'.format(server_error)
-            )
+        check_server_error(reply_data)
 
         return reply_data
 
@@ -257,10 +643,14 @@ class ServerConnection:
                 log.error('Send attempts expired ({}), reconnecting...'.format(str(error)))
             else:
                 log.error('Send attempts expired, reconnecting...')
-            self.reconnect()
+            self._reconnect()
             self._send_attempts = 0
 
-    def send_str_noreply(self, s):
+    def send_str_noreply(self, s) -> Future:
+        """
+        Send a message without waiting for the reply. Returns immediately, with a
+        future which is done once the message was sent or dropped.
+        """
         if type(s) is str:
             data = s.encode('utf-8')
         elif type(s) is not bytes:
@@ -268,14 +658,27 @@ class ServerConnection:
         else:
             raise TypeError('send_str_noreply() requires str or bytes argument.')
 
-        self._sock.send(data, copy=False, track=True)
-        try:
-            sev = dict(self._poller.poll(RESPONSE_WAIT_TIME))
-        except zmq.error.ZMQError as e:
-            self._send_attempt_failed(e)
+        future = self.submit(data, 'noreply request', batchable=True, noreply=True)
+        future.add_done_callback(_log_noreply_failure)
+        return future
 
-        if sev.get(self._sock) == zmq.POLLIN:
-            self._sock.recv_multipart()  # discard reply
-        else:
-            self._send_attempt_failed()
-            log.info('Received no ACK from server for noreply request.')
+    def send_str_durable(self, s: str):
+        """
+        Send a message which must not get lost, without waiting for the reply.
+        The message is kept in the outbox until it was delivered, if we have one.
+        """
+        if self._outbox is None:
+            self.send_str_noreply(s)
+            return
+        self._outbox.post(s, 'durable message')
+
+    def outbox_stats(self) -> dict[str, int] | None:
+        """Statistics of the outbox, if we have one."""
+        return self._outbox.stats() if self._outbox is not None else None
+
+
+def _log_noreply_failure(future: Future):
+    if future.cancelled():
+        log.debug('Dropped queued noreply request.')
+    elif future.exception() is not None:
+        log.info('Received no ACK from server for noreply request: %s', str(future.exception()))
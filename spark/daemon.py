@@ -17,34 +17,64 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
+import time
 import shutil
+import signal
 import logging as log
+import multiprocessing as mp
 from multiprocessing import Process
+from multiprocessing.connection import wait
 
 import zmq
 
+from spark.broker import LighthouseBroker
 from spark.config import LocalConfig
+from spark.leases import JobLeaseQueue
 from spark.worker import Worker
-from spark.connection import ServerConnection
+from spark.scheduler import CpuPartitioner, AdmissionController
+from spark.connection import JobNotifier, ServerConnection
+from spark.utils.misc import Backoff
+from spark.utils.reaper import discard_stale_trees
+from spark.utils.workspace import discard_slot_workspaces
 
 
 class Daemon:
+    # delays (in seconds) before restarting a process which exited unexpectedly
+    RESTART_DELAY_MIN = 5.0
+    RESTART_DELAY_MAX = 600.0
+
+    # a process which ran for this many seconds is not considered to be crash-looping
+    STABLE_RUNTIME = 600
+
+    # interval (in seconds) to log the worker capacity in
+    CAPACITY_LOG_INTERVAL = 3600
+
     def __init__(self, log_level=None):
         if not log_level:
             log_level = log.INFO
         log.basicConfig(level=log_level, format="[%(levelname)s] %(message)s")
+        self._stopping = False
 
-    def run_worker_process(self, worker_name: str, is_primary: bool):
+    def run_worker_process(self, worker_name: str, slot: int):
         """
         Set up connection for a new worker process and launch it.
         This function is executed in a new process.
         """
 
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
         zctx = zmq.Context()
 
-        # initialize Lighthouse connection
-        conn = ServerConnection(self._conf, zctx)
+        # initialize Lighthouse connection, going through the shared broker
+        # if we are one of multiple worker processes
+        broker_endpoint = None
+        if self._conf.max_jobs > 1:
+            broker_endpoint = self._conf.broker_endpoint
+        outbox_fname = os.path.join(self._conf.outbox_dir, '{}.journal'.format(worker_name))
+        conn = ServerConnection(
+            self._conf, zctx, broker_endpoint=broker_endpoint, outbox_fname=outbox_fname
+        )
 
         # connect
         conn.connect()
@@ -54,8 +84,32 @@ class Daemon:
             )
         )
 
-        w = Worker(self._conf, conn, is_primary=is_primary)
+        notifier = None
+        if self._conf.job_notify_server:
+            notifier = JobNotifier(self._conf, zctx)
+
+        w = Worker(
+            self._conf,
+            conn,
+            primary_slot=self._primary_slot,
+            notifier=notifier,
+            leases=self._leases,
+            admission=self._admission,
+            cpus=self._cpus,
+            slot=slot,
+        )
+        signal.signal(signal.SIGTERM, lambda signum, frame: w.stop())
         w.run()
+        conn.close()
+
+    def run_broker_process(self):
+        """
+        Relay the Lighthouse traffic of all worker processes.
+        This function is executed in a new process.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        broker = LighthouseBroker(self._conf, zmq.Context(), self._conf.broker_endpoint)
+        broker.run()
 
     def run(self):
         # check Python platform version - 3.5 works while 3.6 or higher is properly tested
@@ -66,7 +120,8 @@ class Daemon:
             )
         if not shutil.which('debspawn'):
             log.warning(
-                'The "debspawn" tool was not found in PATH, we will not be able to run most actions.'
+                'The "debspawn" tool was not found in PATH, '
+                'we will not be able to run most actions.'
             )
 
         self._conf = LocalConfig()
@@ -74,15 +129,163 @@ class Daemon:
 
         log.info('Maximum number of parallel jobs: {0}'.format(self._conf.max_jobs))
 
+        # no job is running yet, so any workspace still around was left behind by a
+        # previous run - have the workers' reapers remove those in the background
+        try:
+            count = discard_stale_trees(self._conf.workspace_dir)
+            if count:
+                log.info('Discarding {0} stale workspace(s)'.format(count))
+        except OSError as e:
+            log.warning('Unable to discard stale workspaces: {0}'.format(str(e)))
+
+        # jobs fetched from the server but not started yet, shared by all workers
+        self._leases = JobLeaseQueue(self._conf.max_jobs)
+
+        # decides whether the machine has the resources to take another job
+        self._admission = None
+        if self._conf.admission_enabled:
+            self._admission = AdmissionController(self._conf)
+
+        # CPUs the jobs of each slot run on
+        self._cpus = None
+        if self._conf.max_jobs > 1 and self._conf.partition_cpus:
+            self._cpus = CpuPartitioner(self._conf.max_jobs, self._leases)
+
+        # slot of the worker responsible for updating archive data
+        self._primary_slot = mp.Value('i', 0)
+
         # initialize workers
         if self._conf.max_jobs == 1:
             # don't use multiprocess when our maximum amount of jobs is just 1
-            self.run_worker_process('worker_0', is_primary=True)
-        else:
-            is_primary = True
-            for i in range(0, self._conf.max_jobs):
-                worker_name = 'worker_{}'.format(i)
-                p = Process(target=self.run_worker_process, args=(worker_name, is_primary))
-                p.name = worker_name
-                p.start()
-                is_primary = False
+            self.run_worker_process('worker_0', 0)
+            return
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self._supervise()
+
+    def stop(self):
+        """
+        Stop all worker processes, letting them finish their jobs.
+        May be called from a signal handler.
+        """
+        self._stopping = True
+
+    def _start_process(self, name: str, target, args=()) -> Process:
+        p = Process(target=target, args=args)
+        p.name = name
+        p.start()
+        return p
+
+    def _supervise(self) -> None:
+        """
+        Run the broker and all worker processes, and restart them if they exit
+        unexpectedly. Processes which keep crashing are restarted with growing delays.
+        """
+        slots = self._conf.max_jobs
+        broker_key = -1
+        names = {broker_key: 'lighthouse_broker'}
+        names.update({slot: 'worker_{}'.format(slot) for slot in range(slots)})
+        backoffs = {key: Backoff(self.RESTART_DELAY_MIN, self.RESTART_DELAY_MAX) for key in names}
+        procs: dict[int, Process] = {}
+        started: dict[int, float] = {}
+        restart_at: dict[int, float] = {key: 0.0 for key in names}
+        restarts = 0
+        down_since: dict[int, float] = {}
+        lost_time = 0.0
+        next_capacity_log = time.monotonic() + self.CAPACITY_LOG_INTERVAL
+
+        def start(key: int):
+            if key == broker_key:
+                # all workers share a single connection to the server
+                procs[key] = self._start_process(names[key], self.run_broker_process)
+            else:
+                procs[key] = self._start_process(
+                    names[key], self.run_worker_process, (names[key], key)
+                )
+            started[key] = time.monotonic()
+
+        def log_capacity(now: float):
+            lost = lost_time + sum(now - t for t in down_since.values())
+            live = sum(1 for key in procs if key != broker_key)
+            log.info(
+                'Worker capacity: {0}/{1} slot(s) live, {2} restart(s), '
+                '{3:.2f} slot-hours lost'.format(live, slots, restarts, lost / 3600)
+            )
+
+        terminated = False
+        while True:
+            now = time.monotonic()
+            if self._stopping:
+                if not terminated:
+                    log.info('Stopping worker processes.')
+                    for key, p in procs.items():
+                        if key != broker_key:
+                            p.terminate()
+                    terminated = True
+                if not any(key != broker_key for key in procs):
+                    break
+            else:
+                for key, at in list(restart_at.items()):
+                    if now < at:
+                        continue
+                    del restart_at[key]
+                    start(key)
+                    if key in down_since:
+                        lost_time += now - down_since.pop(key)
+                        log_capacity(now)
+                if now >= next_capacity_log:
+                    log_capacity(now)
+                    next_capacity_log = now + self.CAPACITY_LOG_INTERVAL
+
+            timeout = min([1.0] + [at - now for at in restart_at.values()])
+            wait([p.sentinel for p in procs.values()], max(timeout, 0))
+
+            for key, p in list(procs.items()):
+                if p.is_alive():
+                    continue
+                p.join()
+                del procs[key]
+                if self._stopping:
+                    continue
+
+                now = time.monotonic()
+                if now - started[key] >= self.STABLE_RUNTIME:
+                    backoffs[key].reset()
+                delay = backoffs[key].next()
+                restart_at[key] = now + delay
+                restarts += 1
+                log.error(
+                    'Process {0} exited unexpectedly with code {1}, '
+                    'restarting it in {2:.0f}s'.format(names[key], p.exitcode, delay)
+                )
+                if key == broker_key:
+                    continue
+
+                # the slot is idle now, no matter what the worker was doing
+                down_since[key] = now
+                if self._admission:
+                    self._admission.release_dead(key)
+                if self._cpus:
+                    self._cpus.release_dead(key)
+                self._leases.reset_slot(key)
+                try:
+                    # the server would consider the jobs of the worker running forever
+                    for job_id in discard_slot_workspaces(self._conf.workspace_dir, key):
+                        if not os.path.isdir(os.path.join(self._conf.upload_spool_dir, job_id)):
+                            self._leases.put_orphan(job_id)
+                except OSError as e:
+                    log.warning(
+                        'Unable to discard workspaces of {0}: {1}'.format(names[key], str(e))
+                    )
+                if self._primary_slot.value == key:
+                    live = sorted(k for k in procs if k != broker_key)
+                    if live:
+                        log.info('Moving the primary worker role to {0}'.format(names[live[0]]))
+                        self._primary_slot.value = live[0]
+                log_capacity(now)
+
+        # workers are done, so nobody needs the broker anymore
+        broker = procs.pop(broker_key, None)
+        if broker:
+            broker.terminate()
+            broker.join()
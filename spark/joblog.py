@@ -17,11 +17,143 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+import codecs
+import logging as log
 import threading
-from io import StringIO
+from concurrent import futures
 from contextlib import contextmanager
 
+from spark.connection import REQUEST_TIMEOUT
 from spark.utils.misc import to_compact_json
+from spark.utils.compress import encode_text
+
+
+class LogRingBuffer:
+    """
+    Buffer for log output with a fixed capacity.
+
+    If more data is written than fits, the beginning and the most recent
+    part of the data are kept and the amount of bytes dropped in between is counted.
+    """
+
+    def __init__(self, capacity: int):
+        self._head_capacity = capacity // 2
+        self._tail_capacity = capacity - self._head_capacity
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._head) + len(self._tail)
+
+    def write(self, data: bytes):
+        if len(self._head) < self._head_capacity:
+            n = self._head_capacity - len(self._head)
+            self._head += data[:n]
+            data = data[n:]
+            if not data:
+                return
+        self._tail += data
+        excess = len(self._tail) - self._tail_capacity
+        if excess > 0:
+            del self._tail[:excess]
+            self._dropped += excess
+
+    def take(self) -> tuple[bytes, bytes, int]:
+        """Return and clear the buffered head, tail and the amount of dropped bytes."""
+        result = (bytes(self._head), bytes(self._tail), self._dropped)
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._dropped = 0
+        return result
+
+
+class LogSender:
+    """
+    A single thread sending buffered output of all job logs of a worker,
+    as soon as enough data has accumulated or the send interval has expired.
+    """
+
+    def __init__(self, interval: float = 15.0, size_threshold: int = 128 * 1024):
+        self._interval = interval
+        self._size_threshold = size_threshold
+        self._logs: list['JobLog'] = []
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+        # statistics
+        self._excerpts_sent = 0
+        self._bytes_sent = 0
+        self._bytes_dropped = 0
+        self._bytes_on_wire = 0
+        self._slow_sends = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='log-sender', daemon=True)
+        self._thread.start()
+
+    def register(self, jlog: 'JobLog'):
+        with self._cond:
+            self._logs.append(jlog)
+        self.start()
+
+    def unregister(self, jlog: 'JobLog'):
+        with self._cond:
+            if jlog in self._logs:
+                self._logs.remove(jlog)
+
+    def notify_pending(self, pending: int):
+        if pending >= self._size_threshold:
+            with self._cond:
+                self._cond.notify()
+
+    def _due_logs(self) -> list['JobLog']:
+        now = time.monotonic()
+        return [
+            jlog
+            for jlog in self._logs
+            if not jlog.held
+            and (
+                jlog.pending_bytes >= self._size_threshold
+                or (jlog.pending_bytes and now - jlog.last_send_time >= self._interval)
+            )
+        ]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due_logs()
+                if not due:
+                    self._cond.wait(timeout=1.0)
+                    continue
+            for jlog in due:
+                start_time = time.monotonic()
+                try:
+                    jlog.send_pending()
+                except Exception as e:
+                    log.warning('Unable to send log excerpt for %s: %s', jlog.job_id, str(e))
+                if time.monotonic() - start_time > self._interval:
+                    # sending takes longer than we produce data, so we are falling behind
+                    self._slow_sends += 1
+
+    def account(self, sent: int, dropped: int, wire_size: int):
+        self._excerpts_sent += 1
+        self._bytes_sent += sent
+        self._bytes_dropped += dropped
+        self._bytes_on_wire += wire_size
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            'excerpts_sent': self._excerpts_sent,
+            'bytes_sent': self._bytes_sent,
+            'bytes_dropped': self._bytes_dropped,
+            'bytes_on_wire': self._bytes_on_wire,
+            'compression_ratio': round(self._bytes_sent / max(self._bytes_on_wire, 1), 2),
+            'slow_sends': self._slow_sends,
+        }
 
 
 class JobLog:
@@ -30,55 +162,120 @@ class JobLog:
     for a specific job to the server as well as to the local config file.
     """
 
-    def __init__(self, lhconn, job_id, log_fname):
+    # maximum amount of output buffered for sending to the server
+    BUFFER_CAPACITY = 1024 * 1024
+
+    def __init__(self, lhconn, job_id, log_fname, sender: LogSender, compression=None):
         self._conn = lhconn
-        self._buf = StringIO()
-        self._file = open(log_fname, 'w', encoding='utf8')
+        self._sender = sender
+        self._compression = compression
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._buf = LogRingBuffer(self.BUFFER_CAPACITY)
+        self._file = open(log_fname, 'wb')
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
         self._last_msg_excerpt = ''
         self._job_id = job_id
+        self._last_send_time = time.monotonic()
+        self._bytes_written = 0
+        self._bytes_dropped = 0
+        self._unsent: list[futures.Future] = []
 
         self._msg_template = self._conn.new_base_request()
         self._msg_template['request'] = 'job-status'
         self._msg_template['uuid'] = str(job_id)
 
-        self._have_output = False
         self._closed = False
-        self._send_timed()  # start timer
+        self._sender.register(self)
 
     def write(self, s):
-        if isinstance(s, (bytes, bytearray)):
-            s = str(s, 'utf-8')
-        self._buf.write(s)
+        if isinstance(s, str):
+            s = s.encode('utf-8')
         self._file.write(s)
-        self._have_output = True
+        with self._lock:
+            self._buf.write(s)
+            self._bytes_written += len(s)
+            pending = len(self._buf)
+        self._sender.notify_pending(pending)
 
     def flush(self):
         self._file.flush()
 
-    def _send_timed(self):
-        if self._have_output:
-            self._send_buffer()
-        if not self._closed:
-            threading.Timer(15.0, self._send_timed).start()
+    @property
+    def pending_bytes(self) -> int:
+        return len(self._buf)
 
-    def _send_buffer(self):
-        if not self._have_output:
-            return
-        self._have_output = False
-        log_excerpt = self._buf.getvalue()
-        self._buf = StringIO()
+    @property
+    def last_send_time(self) -> float:
+        return self._last_send_time
+
+    @property
+    def held(self) -> bool:
+        """
+        Whether intermediate excerpts are held back, because the server was not told
+        that we accepted the job yet and would not know what to do with them.
+        """
+        return not self._closed and not self._conn.job_status_delivered(self._job_id)
+
+    def _take_excerpt(self) -> tuple[str, int, int]:
+        with self._lock:
+            head, tail, dropped = self._buf.take()
+            self._last_send_time = time.monotonic()
+        if not dropped:
+            # data may end in the middle of a multibyte character, so decode incrementally
+            return self._decoder.decode(head + tail, final=self._closed), len(head) + len(tail), 0
+
+        self._decoder.reset()
+        self._bytes_dropped += dropped
+        excerpt = '{0}\n[... {1} bytes of output omitted ...]\n{2}'.format(
+            str(head, 'utf-8', 'replace'), dropped, str(tail, 'utf-8', 'replace')
+        )
+        return excerpt, len(head) + len(tail), dropped
+
+    def send_pending(self):
+        # the send lock keeps excerpts in order if the sender thread and close() race
+        with self._send_lock:
+            if not self._buf or self.held:
+                return
+            log_excerpt, sent, dropped = self._take_excerpt()
 
-        req = dict(self._msg_template)  # copy the template
-        req['log_excerpt'] = log_excerpt
+            req = dict(self._msg_template)  # copy the template
+            payload, encoding, raw_size, wire_size = encode_text(log_excerpt, self._compression)
+            req['log_excerpt'] = payload
+            if encoding:
+                req['log_excerpt_encoding'] = encoding
+                log.debug(
+                    'Job %s: compressed log excerpt %d -> %d bytes (ratio %.2f)',
+                    self._job_id,
+                    raw_size,
+                    wire_size,
+                    raw_size / max(wire_size, 1),
+                )
 
-        self._conn.send_str_noreply(to_compact_json(req))
-        self._last_msg_excerpt = log_excerpt
+            if self._closed:
+                # the final excerpt must reach the server, even if it is unreachable right now,
+                # and it must not overtake earlier excerpts which are still queued
+                futures.wait(self._unsent, timeout=REQUEST_TIMEOUT)
+                self._unsent = []
+                self._conn.send_str_durable(to_compact_json(req))
+            else:
+                self._unsent = [f for f in self._unsent if not f.done()]
+                self._unsent.append(self._conn.send_str_noreply(to_compact_json(req)))
+            self._last_msg_excerpt = log_excerpt
+            self._sender.account(sent, dropped, wire_size)
 
     def close(self):
-        if self._have_output:
-            self._send_buffer()
+        self._sender.unregister(self)
         self._closed = True
+        self.send_pending()
         self._file.close()
+        if self._bytes_dropped:
+            log.info(
+                'Job %s: %d of %d bytes of output were not sent to the server (buffer full).',
+                self._job_id,
+                self._bytes_dropped,
+                self._bytes_written,
+            )
 
     @property
     def job_id(self) -> str:
@@ -86,8 +283,8 @@ class JobLog:
 
 
 @contextmanager
-def job_log(lhconn, job_id, log_fname):
-    jlog = JobLog(lhconn, job_id, log_fname)
+def job_log(lhconn, job_id, log_fname, sender: LogSender, compression=None):
+    jlog = JobLog(lhconn, job_id, log_fname, sender, compression)
     try:
         yield jlog
     finally:
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import logging as log
+import multiprocessing as mp
+
+from spark.connection import JobStatus
+from spark.utils.misc import SlotLock
+
+
+class JobLeaseQueue:
+    """
+    Jobs which were assigned to this machine but have not been started yet.
+
+    The queue is shared between all worker processes: a worker which asks the server
+    for jobs requests one for every idle slot and leaves the ones it can not run
+    itself here for the other idle workers.
+
+    The state of every job slot is tracked separately, so it can be reset if the
+    worker of a slot dies. Jobs of dead workers are handed to the live ones, to
+    report them to the server.
+    """
+
+    # time to wait for a job to become visible in the queue after it was put there
+    VISIBILITY_DELAY = 0.1
+
+    def __init__(self, slots: int):
+        self._slots = slots
+        self._queue: mp.Queue = mp.Queue()
+        self._orphans: mp.Queue = mp.Queue()
+        self._lock = SlotLock()
+        self._queued = mp.Value('i', 0, lock=False)
+        # whether the worker of each slot is idle, and how many jobs it is asking for
+        self._idle = mp.Array('b', slots, lock=False)
+        self._reserved = mp.Array('i', slots, lock=False)
+
+    def set_idle(self, slot: int, idle: bool):
+        with self._lock.held(slot):
+            self._idle[slot] = 1 if idle else 0
+
+    def reserve(self, slot: int) -> int:
+        """
+        Reserve the amount of jobs we should ask the server for, for ourselves and
+        other idle workers. Jobs which are queued already or which other workers are
+        asking for at the moment are taken into account, so 0 means that we should
+        wait for a job from the queue instead.
+        The reservation has to be ended with :meth:`release` once the request is done.
+        """
+        with self._lock.held(slot):
+            count = max(
+                0, min(sum(self._idle), self._slots) - self._queued.value - sum(self._reserved)
+            )
+            self._reserved[slot] += count
+        return count
+
+    def release(self, slot: int, count: int, took_job: bool = False):
+        """
+        End a reservation of :count jobs, after the leased jobs were put into the queue.
+        If :took_job is set, the calling worker kept a job for itself and is marked as
+        busy in the same step, so it is never counted twice.
+        """
+        with self._lock.held(slot):
+            self._reserved[slot] -= count
+            if took_job:
+                self._idle[slot] = 0
+
+    def reset_slot(self, slot: int):
+        """Forget the state of :slot after its worker died."""
+        with self._lock.held_for_dead(slot):
+            self._idle[slot] = 0
+            self._reserved[slot] = 0
+
+    def put(self, slot: int, job: dict):
+        with self._lock.held(slot):
+            self._queued.value += 1
+        self._queue.put(job)
+
+    def get(self, slot: int, timeout: float | None = None) -> dict | None:
+        """Take a leased job, waiting up to :timeout seconds for one."""
+        try:
+            if timeout is None or timeout <= 0:
+                job = self._queue.get_nowait()
+            else:
+                job = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock.held(slot):
+            self._queued.value -= 1
+        return job
+
+    def __len__(self) -> int:
+        return self._queued.value
+
+    def expected(self) -> int:
+        """Number of jobs which are queued or being asked for, and will start soon."""
+        return self._queued.value + sum(self._reserved)
+
+    def put_orphan(self, job_id: str):
+        """Queue a job a dead worker was busy with, to be reported as failed."""
+        self._orphans.put(job_id)
+
+    def report_orphans(self, conn):
+        """Tell the server that the jobs of dead workers failed."""
+        while True:
+            try:
+                job_id = self._orphans.get_nowait()
+            except queue.Empty:
+                return
+            log.warning('Reporting job \'%s\' of a dead worker as failed.', job_id)
+            conn.send_job_status(job_id, JobStatus.FAILED)
+
+    def return_all(self, slot: int, conn):
+        """Hand all jobs we did not start back to the server."""
+        while True:
+            # a short timeout, as jobs put into the queue only become visible with a small delay
+            job = self.get(slot, timeout=self.VISIBILITY_DELAY)
+            if not job:
+                break
+            job_id = job.get('uuid')
+            log.info('Returning unstarted job \'%s\' to the server.', job_id)
+            conn.send_job_status(job_id, JobStatus.REJECTED)
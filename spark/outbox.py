@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import fcntl
+import logging as log
+import threading
+from typing import NamedTuple
+from collections import deque
+
+from spark.utils.misc import Backoff
+
+
+class OutboxEntry(NamedTuple):
+    """A message waiting for delivery to the server."""
+
+    seq: int
+    what: str
+    data: str
+
+
+class Outbox:
+    '''
+    Durable queue of messages for the Lighthouse server.
+
+    Messages are appended to a journal file before they are handed to a background
+    thread for delivery, so posting a message never blocks and messages survive
+    server outages as well as restarts of the daemon. Messages are delivered at
+    least once and in the order they were posted.
+
+    The journal contains one JSON record per line: either a message, or the
+    acknowledgement of a message having been delivered. Once everything was
+    delivered, the journal is truncated, and if it grows too large while the
+    server is unreachable, delivered entries are compacted away.
+    '''
+
+    # delays (in seconds) before retrying to deliver messages
+    RETRY_MIN = 2.0
+    RETRY_MAX = 120.0
+
+    # maximum number of messages handed to the connection at once
+    MAX_IN_FLIGHT = 32
+
+    # rewrite the journal without delivered entries once it is larger than this
+    COMPACT_THRESHOLD = 1024 * 1024
+
+    def __init__(self, conn, fname: str):
+        self._conn = conn
+        self._fname = fname
+        self._cond = threading.Condition()
+        self._pending: deque[OutboxEntry] = deque()
+        self._seq = 0
+        self._closing = False
+        self._stopped = False
+        self._delivered = 0
+        self._retries = 0
+
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        self._file = open(fname, 'a+', encoding='utf-8')
+        # only one process may own a journal
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._replay()
+        if self._pending:
+            log.info(
+                'Outbox %s: %d undelivered message(s) from a previous run',
+                os.path.basename(fname),
+                len(self._pending),
+            )
+
+        self._thread = threading.Thread(target=self._drain, name='outbox', daemon=True)
+        self._thread.start()
+
+    def _replay(self):
+        self._file.seek(0)
+        entries: dict[int, OutboxEntry] = {}
+        for line in self._file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # an interrupted write may have left a partial record at the end
+                continue
+            if 'ack' in record:
+                entries.pop(record['ack'], None)
+            else:
+                entries[record['seq']] = OutboxEntry(record['seq'], record['what'], record['data'])
+                self._seq = max(self._seq, record['seq'])
+        self._pending.extend(sorted(entries.values()))
+        self._compact()
+
+    def _append(self, record: dict):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _compact(self):
+        '''Rewrite the journal so it only contains undelivered messages.'''
+        tmp_fname = self._fname + '.new'
+        with open(tmp_fname, 'w', encoding='utf-8') as f:
+            for entry in self._pending:
+                f.write(json.dumps(entry._asdict(), separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, self._fname)
+
+        # keep holding the lock on the new file
+        new_file = open(self._fname, 'a+', encoding='utf-8')
+        fcntl.flock(new_file, fcntl.LOCK_EX)
+        self._file.close()
+        self._file = new_file
+
+    def post(self, data: str, what: str = 'message') -> int:
+        '''
+        Record a message and queue it for delivery. Returns immediately, with the
+        sequence number of the message, or 0 if it could not be queued.
+        '''
+        with self._cond:
+            if self._stopped:
+                log.warning('Outbox was already closed, unable to queue %s.', what)
+                return 0
+            self._seq += 1
+            entry = OutboxEntry(self._seq, what, data)
+            self._append(entry._asdict())
+            self._pending.append(entry)
+            self._cond.notify()
+            return entry.seq
+
+    def delivered(self, seq: int) -> bool:
+        '''Whether the message with sequence number :seq was delivered.'''
+        with self._cond:
+            return not self._pending or self._pending[0].seq > seq
+
+    def _acknowledge(self, entry: OutboxEntry):
+        with self._cond:
+            if self._stopped or not self._pending or self._pending[0] != entry:
+                return
+            self._pending.popleft()
+            self._delivered += 1
+            if not self._pending:
+                self._file.truncate(0)
+            else:
+                self._append({'ack': entry.seq})
+                if self._file.tell() > self.COMPACT_THRESHOLD:
+                    self._compact()
+            self._cond.notify_all()
+
+    def _drain(self):
+        backoff = Backoff(self.RETRY_MIN, self.RETRY_MAX)
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if self._stopped or not self._pending:
+                    return
+                entries = list(self._pending)[: self.MAX_IN_FLIGHT]
+
+            futures = [
+                (entry, self._conn.submit(entry.data, entry.what, batchable=True))
+                for entry in entries
+            ]
+            error = None
+            for entry, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    error = e
+                    break
+                self._acknowledge(entry)
+                if self._stopped:
+                    return
+
+            if error is None:
+                backoff.reset()
+                continue
+
+            # messages after the failed one will be sent again, to keep them in order
+            self._retries += 1
+            delay = backoff.next()
+            log.warning(
+                'Unable to deliver %d queued message(s), retrying in %.0fs: %s',
+                len(self._pending),
+                delay,
+                str(error),
+            )
+            with self._cond:
+                if self._stopped:
+                    return
+                self._cond.wait(delay)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'pending': len(self._pending),
+            'delivered': self._delivered,
+            'retries': self._retries,
+        }
+
+    def close(self, timeout: float | None = None):
+        '''
+        Wait up to :timeout seconds for pending messages to be delivered.
+        Undelivered messages remain in the journal for the next run.
+        '''
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not self._pending, timeout)
+            self._stopped = True
+            self._cond.notify_all()
+            if self._pending:
+                log.warning(
+                    'Outbox %s: %d message(s) could not be delivered yet.',
+                    os.path.basename(self._fname),
+                    len(self._pending),
+                )
+            self._file.close()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import fcntl
+import shutil
+import logging as log
+import threading
+from contextlib import contextmanager
+
+from spark.runners import load_prefetch
+
+# marker file for prefetched inputs which are ready to be used
+COMPLETE_MARKER = '.complete'
+
+
+class Prefetcher:
+    '''
+    Download the inputs of jobs we leased, while we are still busy with other work.
+
+    Runners may provide a ``prefetch(job, jdata, dest_dir)`` function, which places
+    everything the job needs in ``dest_dir``. Once a prefetch has finished, the
+    directory is marked as complete, and the worker which eventually runs the job
+    moves its contents into the job's workspace. Runners then skip downloading
+    inputs which are already present.
+
+    The prefetch area is shared by all worker processes: a prefetch in progress
+    holds a lock, which the worker claiming its result waits for.
+    '''
+
+    # prefetched data is removed if nobody claimed it after this many seconds
+    MAX_AGE = 6 * 3600
+
+    def __init__(self, prefetch_dir: str):
+        self._prefetch_dir = prefetch_dir
+        self._lock = threading.Lock()
+        self._active: set[str] = set()
+
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self._prefetch_dir, str(job_id))
+
+    @contextmanager
+    def _locked(self, job_id: str, blocking: bool = True):
+        os.makedirs(self._prefetch_dir, exist_ok=True)
+        with open(self._job_dir(job_id) + '.lock', 'w', encoding='utf-8') as lock_f:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def start(self, job: dict):
+        '''Start downloading the inputs of :job in the background, if its runner supports that.'''
+        job_id = job.get('uuid')
+        prefetch_func = load_prefetch(job.get('kind'))
+        if not job_id or not prefetch_func:
+            return
+        with self._lock:
+            if job_id in self._active:
+                return
+            self._active.add(job_id)
+        threading.Thread(
+            target=self._run,
+            args=(job, prefetch_func),
+            name='prefetch-{}'.format(job_id),
+            daemon=True,
+        ).start()
+
+    def _run(self, job: dict, prefetch_func):
+        job_id = job['uuid']
+        dest_dir = self._job_dir(job_id)
+        try:
+            with self._locked(job_id, blocking=False) as locked:
+                if not locked or os.path.exists(dest_dir):
+                    return
+                start_time = time.monotonic()
+                os.makedirs(dest_dir)
+                try:
+                    prefetch_func(job, job.get('data'), dest_dir)
+                except Exception as e:
+                    log.info('Unable to prefetch inputs of job %s: %s', job_id, str(e))
+                    shutil.rmtree(dest_dir, ignore_errors=True)
+                    return
+                with open(os.path.join(dest_dir, COMPLETE_MARKER), 'w', encoding='utf-8'):
+                    pass
+                log.info(
+                    'Prefetched inputs of job %s in %.1fs', job_id, time.monotonic() - start_time
+                )
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def claim(self, job_id: str, workspace: str) -> bool:
+        '''
+        Move the prefetched inputs of a job into its :workspace, waiting for a
+        prefetch which is still in progress.
+        Returns True if inputs were prefetched.
+        '''
+        dest_dir = self._job_dir(job_id)
+        if not os.path.exists(dest_dir + '.lock'):
+            return False
+        with self._locked(job_id):
+            if not os.path.isfile(os.path.join(dest_dir, COMPLETE_MARKER)):
+                shutil.rmtree(dest_dir, ignore_errors=True)
+                os.unlink(dest_dir + '.lock')
+                return False
+            os.unlink(os.path.join(dest_dir, COMPLETE_MARKER))
+            for name in os.listdir(dest_dir):
+                target = os.path.join(workspace, name)
+                if not os.path.exists(target):
+                    os.rename(os.path.join(dest_dir, name), target)
+            shutil.rmtree(dest_dir, ignore_errors=True)
+            os.unlink(dest_dir + '.lock')
+        log.info('Using prefetched inputs for job %s', job_id)
+        return True
+
+    def prune(self):
+        '''Remove prefetched data nobody claimed in a long time.'''
+        try:
+            entries = list(os.scandir(self._prefetch_dir))
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for entry in entries:
+            if not entry.is_dir() or now - entry.stat().st_mtime < self.MAX_AGE:
+                continue
+            with self._locked(entry.name, blocking=False) as locked:
+                if locked:
+                    log.info('Removing stale prefetched inputs of job %s', entry.name)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    os.unlink(entry.path + '.lock')
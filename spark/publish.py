@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging as log
+import threading
+from typing import NamedTuple
+from email.utils import formatdate
+
+from spark.utils import RunnerResult
+from spark.uploads import UploadQueue, referenced_files
+from spark.connection import JobStatus
+from spark.utils.deb822 import Changes
+from spark.utils.digest import DigestCache
+from spark.utils.reaper import discard_tree
+from spark.utils.staging import StagingReport
+
+
+class PublishTask(NamedTuple):
+    """Everything needed to publish the result of a finished job."""
+
+    job_id: str
+    arch: str
+    repo: str
+    workspace: str
+    build_result: RunnerResult
+    files: list[str]
+    changes: str | None
+
+
+def _artifacts_size(task: PublishTask) -> int:
+    '''Size of the files which will be uploaded for :task.'''
+    fnames = list(task.files)
+    if task.changes:
+        changes_dir = os.path.dirname(task.changes)
+        fnames.append(task.changes)
+        fnames.extend(os.path.join(changes_dir, f) for f in referenced_files(task.changes))
+    size = 0
+    for fname in fnames:
+        try:
+            size += os.stat(fname).st_size
+        except OSError:
+            pass
+    return size
+
+
+class Publisher:
+    '''
+    Publish the results of finished jobs in the background.
+
+    The workspace of a finished job is handed over to a publisher thread, which
+    hashes the artifacts, writes the upload description, queues everything for
+    uploading and finally removes the workspace. Meanwhile the job slot is free to
+    run the next job.
+
+    Submitting blocks while too many publishes are in flight, or while the
+    artifacts being published together with the ones waiting in the upload queue
+    would exceed the disk usage limit.
+    '''
+
+    # interval (in seconds) to check the size of the upload queue in while waiting,
+    # as uploads finish in other processes as well
+    SPOOL_CHECK_INTERVAL = 30.0
+
+    def __init__(
+        self,
+        conn,
+        uploads: UploadQueue,
+        digest_cache: DigestCache,
+        max_in_flight: int = 2,
+        max_bytes: int = 0,
+    ):
+        self._conn = conn
+        self._uploads = uploads
+        self._digest_cache = digest_cache
+        self._max_in_flight = max(max_in_flight, 1)
+        self._max_bytes = max_bytes
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._bytes_in_flight = 0
+        self._threads: list[threading.Thread] = []
+
+    def _has_capacity(self, size: int) -> bool:
+        if self._in_flight >= self._max_in_flight:
+            return False
+        if not self._max_bytes:
+            return True
+        used = self._bytes_in_flight + self._uploads.stats()['bytes_pending']
+        if used == 0:
+            # a single publish is always allowed, no matter how large it is
+            return True
+        return used + size <= self._max_bytes
+
+    def submit(self, task: PublishTask):
+        '''
+        Publish the result of a job in the background.
+        The publisher takes ownership of the job's workspace.
+        '''
+        size = _artifacts_size(task)
+        with self._cond:
+            if not self._has_capacity(size):
+                log.info(
+                    'Waiting for %d publish(es) (%.1f MiB) and queued uploads to finish '
+                    'before taking more work',
+                    self._in_flight,
+                    self._bytes_in_flight / (1024 * 1024),
+                )
+                while not self._has_capacity(size):
+                    self._cond.wait(self.SPOOL_CHECK_INTERVAL)
+            self._in_flight += 1
+            self._bytes_in_flight += size
+
+            self._threads = [t for t in self._threads if t.is_alive()]
+            thread = threading.Thread(
+                target=self._run, args=(task, size), name='publish-{}'.format(task.job_id)
+            )
+            self._threads.append(thread)
+        thread.start()
+
+    def _run(self, task: PublishTask, size: int):
+        try:
+            self._publish(task)
+        except Exception as e:
+            log.error('Unable to publish results of job %s: %s', task.job_id, str(e))
+            self._conn.send_job_status(task.job_id, JobStatus.FAILED)
+        finally:
+            try:
+                discard_tree(task.workspace)
+            except Exception as e:
+                log.warning(
+                    'Unable to remove stale workspace {0}: {1}'.format(task.workspace, str(e))
+                )
+            with self._cond:
+                self._in_flight -= 1
+                self._bytes_in_flight -= size
+                self._cond.notify_all()
+
+    def _publish(self, task: PublishTask):
+        artifacts_dir = os.path.join(task.workspace, 'artifacts')
+        os.makedirs(artifacts_dir, exist_ok=True)
+
+        # write upload description file
+        # (upload additional artifacts which the runner hasn't dealt with,
+        # including the final logfile)
+        dud = Changes()
+        dud['Format'] = '1.8'
+        dud['Date'] = formatdate()
+        dud['Architecture'] = task.arch
+        dud['X-Spark-Job'] = str(task.job_id)
+        dud['X-Spark-Result'] = str(task.build_result)
+
+        staging = StagingReport()
+        fbases = []
+        for f in task.files:
+            fbase = os.path.basename(f)
+            dest = os.path.join(artifacts_dir, fbase)
+            if not os.path.isfile(dest):
+                staging.stage(f, dest)
+            fbases.append(fbase)
+        staging.log_summary('artifacts of job {}'.format(task.job_id))
+        dud.add_files(fbases, cache=self._digest_cache, basedir=artifacts_dir)
+
+        dudf = os.path.join(artifacts_dir, '{}.dud'.format(task.job_id))
+        with open(dudf, 'wb') as fd:
+            dud.dump(fd=fd)
+
+        jstatus = JobStatus.FAILED
+        if task.build_result == RunnerResult.SUCCESS:
+            jstatus = JobStatus.SUCCESS
+
+        # the upload queue reports the job status to the server once the upload is done
+        uploads = [task.changes] if task.changes else []
+        uploads.append(dudf)
+        self._uploads.enqueue(task.job_id, task.repo, jstatus, uploads)
+        log.info('Finished job {0}, {1}'.format(task.job_id, str(jstatus)))
+
+    def stats(self) -> dict[str, int]:
+        return {'in_flight': self._in_flight, 'bytes_in_flight': self._bytes_in_flight}
+
+    def close(self):
+        '''Wait for all publishes in flight to finish.'''
+        with self._cond:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
@@ -30,3 +30,15 @@ def load_module(what):
     path = PLUGINS[what]
     mod = importlib.import_module(path)
     return (mod.run, mod.get_version)
+
+
+def load_prefetch(what):
+    """
+    Get the function a runner uses to download the inputs of a job ahead of time.
+    Returns None if the runner does not support prefetching.
+    """
+    path = PLUGINS.get(what)
+    if not path:
+        return None
+    mod = importlib.import_module(path)
+    return getattr(mod, 'prefetch', None)
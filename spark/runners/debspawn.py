@@ -24,54 +24,120 @@
 import os
 import re
 import glob
-from io import StringIO
+import logging as log
 from datetime import timedelta
 
 import firehose.parsers.gcc as fgcc
-from firehose.model import Stats, Analysis
+from firehose.model import Stats, Analysis, Metadata, Generator
 
 from spark.utils import RunnerError, RunnerResult
+from spark.utils.cpuset import job_cpus, pinned_command
 from spark.utils.command import safe_run, run_logged, run_command
 from spark.utils.firehose import create_firehose
+from spark.utils.srccache import source_cache
+from spark.utils.triggers import LogTrigger, LogTriggerMatcher
 
 STATS = re.compile('Build needed (?P<time>.*), (?P<space>.*) dis(c|k) space')
 
 
-def parse_debspawn_log(log, sut):
-    gccversion = None
-    stats = None
-
-    for line in log.splitlines():
-        flag = 'Toolchain package versions: '
-        stat = STATS.match(line)
-        if stat:
-            info = stat.groupdict()
-            hours, minutes, seconds = [int(x) for x in info['time'].split(':')]
-            timed = timedelta(hours=hours, minutes=minutes, seconds=seconds)
-            stats = Stats(timed.total_seconds())
-        if line.startswith(flag):
-            line = line[len(flag) :].strip()
-            packages = line.split(' ')
-            versions = {}
-            for package in packages:
-                if '_' not in package:
-                    continue
-                b, bv = package.split('_', 1)
-                versions[b] = bv
-            vs = list(filter(lambda x: x.startswith('gcc'), versions))
-            if vs == []:
+TOOLCHAIN_FLAG = b'Toolchain package versions: '
+
+# output which tells us the result of a build before debspawn has finished
+BUILD_TRIGGERS = [
+    # we likely have a missing container image for this build type
+    LogTrigger('missing-environment', rb'^ERROR: The container image for', terminal=True),
+    # we are waiting for dependencies - only while they are installed, as a build's
+    # own scripts or tests may print this too
+    LogTrigger(
+        'depwait',
+        rb'^The following packages have unmet dependencies:',
+        terminal=True,
+        until=rb'^dpkg-buildpackage: ',
+    ),
+]
+
+
+class DebspawnLogAnalyzer:
+    '''
+    Analyze debspawn output line by line while a build is running.
+    Instances are used as line handlers for :func:`run_logged`.
+    '''
+
+    def __init__(self, sut):
+        self._sut = sut
+        self._gcc_func_name = None
+        self.gccversion = None
+        self.stats = None
+        self.issues: list = []
+
+    def _parse_toolchain(self, line_b: bytes):
+        line = str(line_b[len(TOOLCHAIN_FLAG) :], 'utf-8', 'replace')
+        packages = line.strip().split(' ')
+        versions = {}
+        for package in packages:
+            if '_' not in package:
                 continue
-            vs = vs[0]
-            gccversion = versions[vs]
+            b, bv = package.split('_', 1)
+            versions[b] = bv
+        vs = list(filter(lambda x: x.startswith('gcc'), versions))
+        if vs:
+            self.gccversion = versions[vs[0]]
+
+    def _parse_gcc(self, line_b: bytes):
+        # same logic as firehose.parsers.gcc.parse_file(), but only decoding
+        # lines which can possibly be relevant
+        if b': In ' in line_b:
+            match_func = fgcc.FUNCTION_PATTERN.match(str(line_b, 'utf-8', 'replace'))
+            if match_func:
+                self._gcc_func_name = match_func.group('func')
+                return
+        if line_b.endswith(b': At global scope:'):
+            self._gcc_func_name = fgcc.GLOBAL_FUNC_NAME
+            return
+        if self._gcc_func_name is not None:
+            issue = fgcc.parse_warning(str(line_b, 'utf-8', 'replace'), self._gcc_func_name)
+            if issue:
+                self.issues.append(issue)
+            else:
+                # reset this when we run out of warnings associated with it
+                self._gcc_func_name = None
+
+    def __call__(self, line_b: bytes):
+        if line_b.startswith(b'Build needed '):
+            stat = STATS.match(str(line_b, 'utf-8', 'replace'))
+            if stat:
+                info = stat.groupdict()
+                hours, minutes, seconds = [int(x) for x in info['time'].split(':')]
+                timed = timedelta(hours=hours, minutes=minutes, seconds=seconds)
+                self.stats = Stats(timed.total_seconds())
+        elif line_b.startswith(TOOLCHAIN_FLAG):
+            self._parse_toolchain(line_b)
+
+        self._parse_gcc(line_b)
 
-    obj = fgcc.parse_file(StringIO(log), sut=sut, gccversion=gccversion, stats=stats)
+    def gcc_analysis(self) -> Analysis:
+        '''Return the result as a standalone firehose report for GCC.'''
+        generator = Generator(name='gcc', version=self.gccversion)
+        return Analysis(Metadata(generator, self._sut, None, self.stats), list(self.issues))
 
-    return obj
+    def apply(self, analysis: Analysis):
+        '''Add the collected results to an existing firehose report.'''
+        analysis.metadata.stats = self.stats
+        analysis.results.extend(self.issues)
+
+
+def parse_debspawn_log(log_text, sut):
+    analyzer = DebspawnLogAnalyzer(sut)
+    lines = log_text.splitlines() if isinstance(log_text, str) else log_text
+    for line in lines:
+        analyzer(line.encode('utf-8'))
+
+    return analyzer.gcc_analysis()
 
 
 def debspawn_build(
     jlog, dsc, maintainer, suite, affinity, build_arch, build_indep, analysis: Analysis
-) -> tuple[Analysis, str, bool, bool, list[str] | None]:
+) -> tuple[Analysis, bool, bool, list[str] | None]:
     if not dsc.endswith('.dsc'):
         raise ValueError('WTF')
 
@@ -91,29 +157,59 @@ def debspawn_build(
         ds_cmd.append('--only=binary')
     if maintainer:
         ds_cmd.append('--maintainer={maintainer}'.format(maintainer=maintainer))
+    cpus = job_cpus()
+    if cpus:
+        # match the build's parallelism to the CPUs it may use
+        ds_cmd.append('--setenv=DEB_BUILD_OPTIONS=parallel={}'.format(len(cpus)))
     ds_cmd.append(suite)
     ds_cmd.append(dsc)
 
-    ret, out = run_logged(jlog, ds_cmd, True)
-    for line in out.splitlines():
-        if ret != 0:
-            if line.startswith('ERROR: The container image for'):
-                # We likely have a missing container image for this build type
-                raise RunnerError('This worker is missing an environment: {}'.format(line))
-            elif 'The following packages have unmet dependencies:' in line:
-                # We are waiting for dependencies
-                return (analysis, out, True, True, None)
-
-    ftbfs = ret != 0
+    # analyze the build log while it is being generated, and stop the build
+    # as soon as we know that it can not succeed
+    triggers = LogTriggerMatcher(BUILD_TRIGGERS)
+    analyzer = DebspawnLogAnalyzer(analysis.metadata.sut)
+    ret, _ = run_logged(jlog, pinned_command(ds_cmd), line_handlers=[triggers, analyzer])
+    # debspawn may exit cleanly after being interrupted, so an aborted build
+    # never counts as a success
+    if triggers.fired == 'missing-environment':
+        raise RunnerError('This worker is missing an environment: {}'.format(triggers.fired_line))
+    if triggers.fired == 'depwait':
+        return (analysis, True, True, None)
+    analyzer.apply(analysis)
+
+    ftbfs = ret != 0 or triggers.fired is not None
     base, _ = os.path.basename(dsc).rsplit('.', 1)
     changes = glob.glob('{base}_*.changes'.format(base=base))
 
-    return (analysis, out, ftbfs, False, changes)
+    return (analysis, ftbfs, False, changes)
+
+
+def fetch_source(dsc_url, dest_dir):
+    cache = source_cache()
+    if cache:
+        try:
+            cache.fetch_source(dsc_url, dest_dir)
+            return
+        except Exception as e:
+            log.warning(
+                'Unable to fetch %s via the source cache, downloading it directly: %s',
+                dsc_url,
+                str(e),
+            )
+    safe_run(['dget', '-u', '-d', dsc_url], cwd=dest_dir)
 
 
 def checkout(dsc_url):
-    safe_run(['dget', '-u', '-d', dsc_url])
-    return os.path.basename(dsc_url)
+    dsc = os.path.basename(dsc_url)
+    if os.path.isfile(dsc):
+        # the source package was prefetched already
+        return dsc
+    fetch_source(dsc_url, os.getcwd())
+    return dsc
+
+
+def prefetch(job, jdata, dest_dir):
+    fetch_source(jdata['dsc_url'], dest_dir)
 
 
 def get_version():
@@ -136,20 +232,17 @@ def run(
     )
 
     dsc = checkout(jdata['dsc_url'])
-    (
-        firehose,
-        out,
-        ftbfs,
-        depwait,
-        changes_list,
-    ) = debspawn_build(
+    firehose, ftbfs, depwait, changes_list = debspawn_build(
         jlog, dsc, maintainer, jdata['suite'], arch_name, build_arch, build_indep, firehose
     )
 
     if not changes_list and not ftbfs:
-        print(out)
-        print(changes_list)
-        print(list(glob.glob('*')))
+        # the build output is in the job log already
+        log.error(
+            'Build of %s produced no changes file, workspace contains: %s',
+            dsc,
+            ', '.join(sorted(glob.glob('*'))),
+        )
         raise RunnerError('Um. No changes but no FTBFS.')
 
     changes: str | None = None
@@ -22,7 +22,8 @@ import glob
 import shlex
 
 from spark.utils import RunnerError, RunnerResult
-from spark.utils.command import safe_run, run_logged
+from spark.utils.command import run_logged
+from spark.utils.gitcache import git_clone
 from spark.utils.workspace import make_commandfile, debspawn_run_commandfile
 
 
@@ -43,8 +44,9 @@ def build_image(
     env_name = jdata.get('environment')
     image_style = jdata.get('style')
 
-    # clone the image build recipe repository
-    safe_run(['git', 'clone', '--depth=1', jdata.get('git_url'), 'ib'])
+    # clone the image build recipe repository, unless it was prefetched already
+    if not os.path.isdir(os.path.join('ib', '.git')):
+        git_clone(jdata.get('git_url'), 'ib')
     run_logged(jlog, ['git', 'log', '--pretty=oneline', '-1'], cwd=os.path.abspath('ib'))
 
     # test if we have a prepare script and something to cache
@@ -99,6 +101,10 @@ def build_image(
     return RunnerResult.SUCCESS, files, None
 
 
+def prefetch(job, jdata, dest_dir):
+    git_clone(jdata.get('git_url'), os.path.join(dest_dir, 'ib'))
+
+
 def run(
     jlog, job, jdata
 ) -> tuple[RunnerResult, list[os.PathLike | str] | None, os.PathLike | None]:
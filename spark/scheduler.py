@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging as log
+import multiprocessing as mp
+from enum import StrEnum
+from typing import NamedTuple
+from contextlib import contextmanager
+
+from spark.config import LocalConfig
+from spark.leases import JobLeaseQueue
+from spark.utils.misc import SlotLock, pressure_avg10
+from spark.utils.cpuset import numa_nodes, split_cpus, set_job_cpus, format_cpu_list
+
+
+class RefusalReason(StrEnum):
+    """Why a worker was not allowed to take another job"""
+
+    MAX_JOBS = 'max-jobs'  # the hard limit of parallel jobs was reached
+    COOLDOWN = 'cooldown'  # a job was started too recently to judge its resource usage
+    PENDING = 'pending'  # another worker is asking the server for a job already
+    DISK = 'disk'  # not enough free space in the workspace
+    LOAD = 'load'  # the system load is too high
+    MEMORY = 'memory'  # not enough available memory
+    MEMORY_PRESSURE = 'memory-pressure'  # tasks are stalled waiting for memory
+
+
+class HostResources(NamedTuple):
+    """Snapshot of the resources of this machine"""
+
+    cpus: int
+    load: float  # 1-minute load average
+    mem_available: int | None  # bytes, None if unknown
+    mem_pressure: float | None  # PSI "some" avg10 in percent, None if unknown
+    disk_free: int  # bytes available in the workspace
+
+
+def read_host_resources(workspace_dir: str) -> HostResources:
+    mem_available = None
+    try:
+        with open('/proc/meminfo', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    mem_available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+
+    os.makedirs(workspace_dir, exist_ok=True)
+    st = os.statvfs(workspace_dir)
+    return HostResources(
+        cpus=os.cpu_count() or 1,
+        load=os.getloadavg()[0],
+        mem_available=mem_available,
+        mem_pressure=pressure_avg10('memory'),
+        disk_free=st.f_bavail * st.f_frsize,
+    )
+
+
+class AdmissionController:
+    """
+    Decide whether a worker may ask the server for another job, based on the
+    resources this machine has left.
+
+    The controller is shared by all worker processes. Decisions are made one at a
+    time, and after a job was started, no other one is admitted until the
+    cooldown time has passed, so the resource usage of the new job can show up
+    in the numbers we look at. A worker which was admitted but did not get a job
+    from the server does not count as having started one, and a worker which is
+    waiting for the server for long does not hold up the others. While no job is
+    running, only the free disk space is checked, so a machine which is busy with
+    other things still makes progress. MaxJobs remains the hard limit of parallel
+    jobs.
+    """
+
+    # interval (in seconds) to log admission statistics in
+    STATS_INTERVAL = 600
+
+    # time (in seconds) an admitted worker asking the server for a job keeps others
+    # from being admitted
+    PENDING_TIMEOUT = 10.0
+
+    # states of a job slot
+    SLOT_IDLE = 0
+    SLOT_ADMITTED = 1  # asking the server for a job
+    SLOT_RUNNING = 2
+
+    def __init__(self, conf: LocalConfig):
+        self._max_jobs = conf.max_jobs
+        self._workspace_dir = conf.workspace_dir
+        self._max_load = conf.admission_max_load
+        self._min_free_memory = conf.admission_min_free_memory
+        self._max_memory_pressure = conf.admission_max_memory_pressure
+        self._min_free_disk = conf.admission_min_free_disk
+        self._cooldown = conf.admission_cooldown
+
+        self._reasons = list(RefusalReason)
+        self._lock = SlotLock()
+        self._slots = mp.Array('b', conf.max_jobs, lock=False)
+        self._admitted_at = mp.Array('d', conf.max_jobs, lock=False)
+        self._last_admission = mp.Value('d', 0.0, lock=False)
+        self._last_stats = mp.Value('d', time.monotonic(), lock=False)
+        self._admitted = mp.Value('i', 0, lock=False)
+        self._refused = mp.Array('i', len(self._reasons), lock=False)
+
+    def _check(self, now: float) -> RefusalReason | None:
+        if sum(1 for state in self._slots if state != self.SLOT_IDLE) >= self._max_jobs:
+            return RefusalReason.MAX_JOBS
+        if any(
+            state == self.SLOT_ADMITTED and now - self._admitted_at[i] < self.PENDING_TIMEOUT
+            for i, state in enumerate(self._slots)
+        ):
+            return RefusalReason.PENDING
+        running = self._running()
+        if running > 0 and now - self._last_admission.value < self._cooldown:
+            return RefusalReason.COOLDOWN
+
+        res = read_host_resources(self._workspace_dir)
+        if res.disk_free < self._min_free_disk:
+            return RefusalReason.DISK
+        if running == 0:
+            return None
+        if self._max_load > 0 and res.load / res.cpus > self._max_load:
+            return RefusalReason.LOAD
+        if res.mem_available is not None and res.mem_available < self._min_free_memory:
+            return RefusalReason.MEMORY
+        if (
+            self._max_memory_pressure > 0
+            and res.mem_pressure is not None
+            and res.mem_pressure > self._max_memory_pressure
+        ):
+            return RefusalReason.MEMORY_PRESSURE
+        return None
+
+    def admit(self, slot: int) -> bool:
+        """
+        Ask for permission to request another job for :slot.
+        If True is returned, :meth:`started` must be called if a job was actually
+        started, and :meth:`release` once the job is done or none was received.
+        """
+        with self._lock.held(slot):
+            now = time.monotonic()
+            try:
+                reason = self._check(now)
+            except OSError as e:
+                log.warning('Unable to determine available resources: %s', str(e))
+                reason = None
+
+            if reason:
+                self._refused[self._reasons.index(reason)] += 1
+                log.debug('Not taking another job: %s', reason)
+            else:
+                self._slots[slot] = self.SLOT_ADMITTED
+                self._admitted_at[slot] = now
+
+            if now - self._last_stats.value >= self.STATS_INTERVAL:
+                self._last_stats.value = now
+                log.info('Admission statistics: %s', self._stats())
+        return reason is None
+
+    def started(self, slot: int):
+        """Record that the worker of an admitted :slot started a job."""
+        with self._lock.held(slot):
+            self._slots[slot] = self.SLOT_RUNNING
+            self._admitted.value += 1
+            self._last_admission.value = time.monotonic()
+
+    def release(self, slot: int):
+        """Mark the job admitted for :slot as done."""
+        with self._lock.held(slot):
+            self._slots[slot] = self.SLOT_IDLE
+
+    def release_dead(self, slot: int):
+        """Mark :slot as idle after its worker died, no matter what it was doing."""
+        with self._lock.held_for_dead(slot):
+            self._slots[slot] = self.SLOT_IDLE
+
+    def _running(self) -> int:
+        return sum(1 for state in self._slots if state == self.SLOT_RUNNING)
+
+    def _stats(self) -> dict[str, int]:
+        stats = {'running': self._running(), 'admitted': self._admitted.value}
+        for i, reason in enumerate(self._reasons):
+            stats['refused-' + reason] = self._refused[i]
+        return stats
+
+    def stats(self) -> dict[str, int]:
+        """Number of running and admitted jobs, and refusals by reason."""
+        with self._lock.held():
+            return self._stats()
+
+
+class CpuPartitioner:
+    """
+    Give every job slot its own set of CPUs, so parallel builds do not compete for
+    the same cores.
+
+    The CPUs are split into one set per slot, keeping sets within a NUMA node where
+    possible. A job which starts while other slots are idle borrows some of their
+    CPUs, preferring sets close to its own, and hands them back when it is done.
+    Builds which are already running keep the CPUs they started with, so a slot whose
+    set was lent out shares it with the borrower until that job is finished. To keep
+    that rare, the sets of slots expected to start a job soon are not lent out, and
+    a job borrows at most half of the remaining idle sets.
+    """
+
+    def __init__(self, slots: int, leases: JobLeaseQueue | None = None):
+        self._sets = split_cpus(numa_nodes(), slots)
+        self._leases = leases
+        self._lock = SlotLock()
+        self._busy = mp.Array('b', slots, lock=False)
+        self._lent_to = mp.Array('i', [-1] * slots, lock=False)
+        log.info(
+            'CPU sets of job slots: %s', ' | '.join(format_cpu_list(cpus) for cpus in self._sets)
+        )
+
+    def claim(self, slot: int) -> list[int]:
+        """Mark :slot as busy and get the CPUs its job may use."""
+        with self._lock.held(slot):
+            self._busy[slot] = 1
+            cpus = list(self._sets[slot])
+            idle = [
+                other
+                for other in sorted(range(len(self._sets)), key=lambda i: abs(i - slot))
+                if not self._busy[other] and self._lent_to[other] < 0
+            ]
+            if self._leases is not None:
+                idle = idle[: max(0, len(idle) - self._leases.expected())]
+            for other in idle[: (len(idle) + 1) // 2]:
+                self._lent_to[other] = slot
+                cpus.extend(self._sets[other])
+        return sorted(set(cpus))
+
+    def _release(self, slot: int):
+        self._busy[slot] = 0
+        for other in range(len(self._sets)):
+            if self._lent_to[other] == slot:
+                self._lent_to[other] = -1
+
+    def release(self, slot: int):
+        """Mark :slot as idle again, returning the CPUs it borrowed."""
+        with self._lock.held(slot):
+            self._release(slot)
+
+    def release_dead(self, slot: int):
+        """Return the CPUs of :slot after its worker died."""
+        with self._lock.held_for_dead(slot):
+            self._release(slot)
+
+    @contextmanager
+    def job_cpus(self, slot: int):
+        """Restrict the job run by :slot in this process to its CPUs while in this context."""
+        cpus = self.claim(slot)
+        set_job_cpus(cpus)
+        try:
+            yield cpus
+        finally:
+            set_job_cpus(None)
+            self.release(slot)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import logging as log
+import threading
+from contextlib import contextmanager
+
+from debian.deb822 import Changes
+
+from spark.connection import JobStatus
+from spark.utils.misc import dput, sign
+from spark.utils.staging import StagingReport
+
+# name of the file describing a queued upload
+MANIFEST_FNAME = 'manifest.json'
+
+# prefix of entries which are being removed
+REMOVED_PREFIX = '.removed-'
+
+
+def referenced_files(upload_fname: str) -> list[str]:
+    '''Get the names of all files a .changes or .dud file references.'''
+    with open(upload_fname, 'r', encoding='utf-8') as f:
+        changes = Changes(f)
+    return [entry['name'] for entry in changes.get('Files', [])]
+
+
+class UploadQueue:
+    '''
+    Durable queue of uploads to the archive.
+
+    Every queued job gets a directory in the spool area, containing its upload
+    description files, all files they reference (hardlinked if possible) and a
+    manifest tracking which files were already signed and uploaded. Uploads are
+    processed by a background thread and retried with increasing delays, so job
+    slots do not need to wait for them. Entries are claimed with a lock, so all
+    worker processes can share one spool and leftovers of a previous run are picked
+    up after a restart.
+
+    Once all files of a job are uploaded, its final status is sent to the server.
+    If uploading keeps failing for too long, the job is reported as failed instead.
+    '''
+
+    # delays (in seconds) before retrying a failed upload
+    RETRY_MIN = 30.0
+    RETRY_MAX = 1800.0
+
+    # give up uploading a job after this many seconds
+    GIVE_UP_AGE = 12 * 3600
+
+    # maximum time (in seconds) between checks for work
+    SCAN_INTERVAL = 30.0
+
+    def __init__(self, conf, conn):
+        self._spool_dir = conf.upload_spool_dir
+        self._gpg_key_id = conf.gpg_key_id
+        self._dput_cf_fname = conf.dput_cf_fname
+        self._conn = conn
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+
+    def _entry_dir(self, job_id: str) -> str:
+        return os.path.join(self._spool_dir, str(job_id))
+
+    def _entries(self) -> list[str]:
+        try:
+            names = os.listdir(self._spool_dir)
+        except FileNotFoundError:
+            return []
+        # entries which are still being created have a dot prefix
+        entries = [os.path.join(self._spool_dir, n) for n in names if not n.startswith('.')]
+        return [e for e in entries if os.path.isdir(e)]
+
+    def _remove(self, entry: str):
+        '''
+        Remove a queued upload we hold the lock of. It is renamed first, so nobody can
+        recreate files in it while it is being removed.
+        '''
+        removed = os.path.join(
+            self._spool_dir,
+            '{}{}-{}'.format(REMOVED_PREFIX, os.path.basename(entry), uuid.uuid4().hex[:12]),
+        )
+        os.rename(entry, removed)
+        shutil.rmtree(removed)
+
+    @contextmanager
+    def _claimed(self, entry: str, blocking: bool = False):
+        '''
+        Hold the lock of a queued upload. Yields False if it is gone, or if it is
+        claimed by someone else and we are not :blocking.
+        '''
+        lock_fname = os.path.join(entry, '.lock')
+        try:
+            lock_f = open(lock_fname, 'w', encoding='utf-8')
+        except OSError:
+            # the upload was finished by someone else in the meantime
+            yield False
+            return
+        with lock_f:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker is busy with this upload
+                yield False
+                return
+            try:
+                # whoever held the lock before us may have removed the entry
+                try:
+                    claimed = os.stat(lock_fname).st_ino == os.fstat(lock_f.fileno()).st_ino
+                except FileNotFoundError:
+                    claimed = False
+                yield claimed
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _remove_leftovers(self):
+        '''Remove entries whose removal was interrupted.'''
+        try:
+            names = os.listdir(self._spool_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith(REMOVED_PREFIX):
+                shutil.rmtree(os.path.join(self._spool_dir, name), ignore_errors=True)
+
+    @staticmethod
+    def _read_manifest(entry: str) -> dict:
+        with open(os.path.join(entry, MANIFEST_FNAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_manifest(entry: str, manifest: dict):
+        fname = os.path.join(entry, MANIFEST_FNAME)
+        with open(fname + '.new', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fname + '.new', fname)
+
+    def enqueue(self, job_id, repo: str, status: JobStatus, uploads: list[str]):
+        '''
+        Queue the upload description files :uploads of a job for uploading to :repo.
+        The server is told about the job's :status once all uploads are done.
+        '''
+        entry = self._entry_dir(job_id)
+        tmp_entry = os.path.join(self._spool_dir, '.{}'.format(job_id))
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        os.makedirs(tmp_entry)
+
+        staging = StagingReport()
+        total_size = 0
+        for upload_fname in uploads:
+            src_dir = os.path.dirname(os.path.abspath(upload_fname))
+            for fname in referenced_files(upload_fname) + [os.path.basename(upload_fname)]:
+                dest = os.path.join(tmp_entry, fname)
+                if os.path.exists(dest):
+                    continue
+                staging.stage(os.path.join(src_dir, fname), dest)
+                total_size += os.path.getsize(dest)
+        staging.log_summary('upload of job {}'.format(job_id))
+
+        manifest = {
+            'job_id': str(job_id),
+            'repo': repo,
+            'status': str(status),
+            'uploads': [os.path.basename(f) for f in uploads],
+            'signed': [],
+            'uploaded': [],
+            'attempts': 0,
+            'created': time.time(),
+            'next_attempt': 0,
+            'size': total_size,
+        }
+        self._write_manifest(tmp_entry, manifest)
+        if os.path.isdir(entry):
+            # the job was run again while its previous result was still queued
+            with self._claimed(entry, blocking=True) as claimed:
+                if claimed:
+                    log.info('Replacing queued upload of job %s', job_id)
+                    self._remove(entry)
+        os.rename(tmp_entry, entry)
+
+        log.info('Queued upload of job %s (%.1f MiB)', job_id, total_size / (1024 * 1024))
+        with self._cond:
+            self._cond.notify()
+
+    def _upload(self, entry: str, manifest: dict):
+        for fname in manifest['uploads']:
+            if fname in manifest['uploaded']:
+                continue
+            upload_fname = os.path.join(entry, fname)
+            if fname not in manifest['signed']:
+                sign(upload_fname, self._gpg_key_id)
+                manifest['signed'].append(fname)
+                self._write_manifest(entry, manifest)
+
+            # dput refuses to upload again if it finds the log of an earlier attempt
+            for dput_log in glob.glob(os.path.splitext(upload_fname)[0] + '.*.upload'):
+                os.unlink(dput_log)
+            dput(upload_fname, manifest['repo'], self._dput_cf_fname)
+            manifest['uploaded'].append(fname)
+            self._write_manifest(entry, manifest)
+
+    def _process(self, entry: str):
+        manifest = self._read_manifest(entry)
+        if manifest['next_attempt'] > time.time():
+            return
+        job_id = manifest['job_id']
+
+        try:
+            self._upload(entry, manifest)
+        except Exception as e:
+            manifest['attempts'] += 1
+            if time.time() - manifest['created'] > self.GIVE_UP_AGE:
+                log.error(
+                    'Giving up uploading job %s after %d attempts: %s',
+                    job_id,
+                    manifest['attempts'],
+                    str(e),
+                )
+                self._conn.send_job_status(job_id, JobStatus.FAILED)
+                self._remove(entry)
+                return
+            delay = min(self.RETRY_MIN * 2 ** (manifest['attempts'] - 1), self.RETRY_MAX)
+            manifest['next_attempt'] = time.time() + delay
+            self._write_manifest(entry, manifest)
+            log.warning(
+                'Upload of job %s failed (attempt %d), retrying in %.0fs: %s',
+                job_id,
+                manifest['attempts'],
+                delay,
+                str(e),
+            )
+            return
+
+        self._conn.send_job_status(job_id, manifest['status'])
+        self._remove(entry)
+        log.info('Uploaded job %s, %s', job_id, manifest['status'])
+
+    def process_pending(self):
+        '''Try to upload all queued jobs which are due and not claimed by someone else.'''
+        for entry in sorted(self._entries()):
+            if self._stopping:
+                break
+            with self._claimed(entry) as claimed:
+                if not claimed:
+                    continue
+                try:
+                    if os.path.isfile(os.path.join(entry, MANIFEST_FNAME)):
+                        self._process(entry)
+                    else:
+                        # entries are created with their manifest, so this is a leftover
+                        log.warning('Removing queued upload %s without manifest', entry)
+                        self._remove(entry)
+                except Exception as e:
+                    log.error('Unable to process queued upload %s: %s', entry, str(e))
+
+    def stats(self) -> dict[str, float]:
+        '''Number of queued jobs, age of the oldest one (in seconds) and bytes pending.'''
+        depth = 0
+        oldest = 0.0
+        pending = 0
+        now = time.time()
+        for entry in self._entries():
+            try:
+                manifest = self._read_manifest(entry)
+            except (OSError, ValueError):
+                continue
+            depth += 1
+            oldest = max(oldest, now - manifest['created'])
+            pending += manifest['size']
+        return {'depth': depth, 'oldest_age': oldest, 'bytes_pending': pending}
+
+    def _run(self):
+        while not self._stopping:
+            self.process_pending()
+            stats = self.stats()
+            if stats['depth']:
+                log.info(
+                    'Upload queue: %d job(s), %.1f MiB pending, oldest %.0fs',
+                    stats['depth'],
+                    stats['bytes_pending'] / (1024 * 1024),
+                    stats['oldest_age'],
+                )
+            with self._cond:
+                if not self._stopping:
+                    self._cond.wait(self.SCAN_INTERVAL)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self._spool_dir, exist_ok=True)
+        self._remove_leftovers()
+        self._thread = threading.Thread(target=self._run, name='uploader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stop processing uploads. Uploads in progress are finished first.'''
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -18,9 +18,17 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
 import shlex
+import bisect
+import signal
+import logging as log
+import tempfile
+import selectors
 import subprocess
-from io import StringIO
+from array import array
+from typing import BinaryIO
 
 
 class SubprocessError(Exception):
@@ -38,7 +46,7 @@ class SubprocessError(Exception):
 
 
 # Input may be a byte string, a unicode string, or a file-like object
-def run_command(command, input=None):
+def run_command(command, input=None, cwd=None):
     if not isinstance(command, list):
         command = shlex.split(command)
 
@@ -56,6 +64,7 @@ def run_command(command, input=None):
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            cwd=cwd,
         )
     except OSError:
         return (None, None, -1)
@@ -65,11 +74,11 @@ def run_command(command, input=None):
     return (output, stderr, pipe.returncode)
 
 
-def safe_run(cmd, input=None, expected=0):
+def safe_run(cmd, input=None, expected=0, cwd=None):
     if not isinstance(expected, tuple):
         expected = (expected,)
 
-    out, err, ret = run_command(cmd, input=input)
+    out, err, ret = run_command(cmd, input=input, cwd=cwd)
 
     if ret not in expected:
         raise SubprocessError(out, err, ret, cmd)
@@ -77,7 +86,299 @@ def safe_run(cmd, input=None, expected=0):
     return out, err, ret
 
 
-def run_logged(jlog, cmd: list[str], return_output=False, **kwargs):
+class AbortCommand(Exception):
+    '''Raised by output line handlers to terminate the running command early.'''
+
+
+class OutputPump:
+    '''Read the output of a process in large chunks and distribute it.
+
+    Raw data is passed to all sinks (objects with a ``write(bytes)`` method) as
+    soon as it was read, without being decoded. Line handlers are called with every
+    complete line (as bytes, without the trailing newline).
+
+    If a line handler raises :class:`AbortCommand`, no further lines are analyzed,
+    the process is interrupted and the remaining output is still collected.
+    Interrupting (rather than terminating) the process gives tools like debspawn the
+    chance to stop their containers and unmount their overlays before exiting.
+    '''
+
+    # amount of data to read at once
+    CHUNK_SIZE = 256 * 1024
+
+    # lines longer than this are passed to the line handlers in pieces
+    MAX_LINE_LENGTH = 1024 * 1024
+
+    # time to wait for more output once the process has exited, in case
+    # a child process which it has left behind still holds its output open
+    EXIT_GRACE_TIME = 5.0
+
+    # time a process has to exit after being interrupted before it is killed
+    TERMINATE_GRACE_TIME = 60.0
+
+    def __init__(self, sinks=None, line_handlers=None):
+        self._sinks = list(sinks) if sinks else []
+        self._line_handlers = list(line_handlers) if line_handlers else []
+        self._partial: list[bytes] = []
+        self._partial_len = 0
+        self._bytes_read = 0
+        self._proc: subprocess.Popen | None = None
+        self._abort_reason: str | None = None
+        self._abort_time = 0.0
+
+    def add_sink(self, sink):
+        self._sinks.append(sink)
+
+    def add_line_handler(self, handler):
+        self._line_handlers.append(handler)
+
+    @property
+    def bytes_read(self) -> int:
+        return self._bytes_read
+
+    @property
+    def abort_reason(self) -> str | None:
+        '''Reason the process was terminated early for, if a line handler requested that.'''
+        return self._abort_reason
+
+    def _abort(self, reason: str):
+        self._abort_reason = reason
+        self._abort_time = time.monotonic()
+        self._line_handlers = []
+        if self._proc is not None and self._proc.poll() is None:
+            log.info('Interrupting command early: %s', reason)
+            self._proc.send_signal(signal.SIGINT)
+
+    def _emit_line(self, line: bytes):
+        for handler in self._line_handlers:
+            try:
+                handler(line)
+            except AbortCommand as e:
+                self._abort(str(e))
+                break
+
+    def _split_lines(self, data: bytes):
+        if b'\n' not in data:
+            self._partial.append(data)
+            self._partial_len += len(data)
+            if self._partial_len >= self.MAX_LINE_LENGTH:
+                self._emit_line(b''.join(self._partial))
+                self._partial = []
+                self._partial_len = 0
+            return
+
+        lines = data.split(b'\n')
+        if self._partial:
+            self._partial.append(lines[0])
+            lines[0] = b''.join(self._partial)
+        tail = lines.pop()
+        self._partial = [tail] if tail else []
+        self._partial_len = len(tail)
+        for line in lines:
+            self._emit_line(line)
+
+    def feed(self, data: bytes):
+        self._bytes_read += len(data)
+        for sink in self._sinks:
+            sink.write(data)
+        if self._line_handlers:
+            self._split_lines(data)
+
+    def finish(self):
+        '''Flush an incomplete last line to the line handlers.'''
+        if self._partial:
+            self._emit_line(b''.join(self._partial))
+            self._partial = []
+            self._partial_len = 0
+
+    def run(self, fd: int, proc: subprocess.Popen | None = None):
+        '''Pump all data from file descriptor :fd until it is closed.'''
+        os.set_blocking(fd, False)
+        self._proc = proc
+        exit_time = None
+        killed = False
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                # checked on every iteration, as an aborted process may keep writing output
+                if (
+                    proc is not None
+                    and not killed
+                    and self._abort_reason is not None
+                    and time.monotonic() - self._abort_time > self.TERMINATE_GRACE_TIME
+                    and proc.poll() is None
+                ):
+                    proc.kill()
+                    killed = True
+                if not sel.select(timeout=1.0):
+                    if proc is None or proc.poll() is None:
+                        continue
+                    if exit_time is None:
+                        exit_time = time.monotonic()
+                    elif time.monotonic() - exit_time > self.EXIT_GRACE_TIME:
+                        break
+                    continue
+                try:
+                    data = os.read(fd, self.CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                self.feed(data)
+        self.finish()
+
+
+class OutputCapture:
+    '''Captured output of a process.
+
+    Data is kept in memory up to a limit and spilled to an anonymous temporary
+    file once that is exceeded. The captured output can be accessed line by line
+    without ever loading all of it into memory.
+    '''
+
+    # default amount of output to keep in memory
+    MEMORY_LIMIT = 16 * 1024 * 1024
+
+    # amount of data to read at once when scanning spilled output
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, memory_limit: int | None = None, spill_dir: str | None = None):
+        self._memory_limit = memory_limit if memory_limit is not None else self.MEMORY_LIMIT
+        self._spill_dir = spill_dir if spill_dir else os.getcwd()
+        self._mem = bytearray()
+        self._file: BinaryIO | None = None
+        self._size = 0
+        self._newlines = 0
+        self._last_byte = b''
+        # sparse line index: byte offset of every written chunk and the
+        # amount of newlines that precede it
+        self._idx_offsets = array('Q')
+        self._idx_newlines = array('Q')
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        self._idx_offsets.append(self._size)
+        self._idx_newlines.append(self._newlines)
+        self._newlines += data.count(b'\n')
+        self._size += len(data)
+        self._last_byte = data[-1:]
+
+        if self._file is None and len(self._mem) + len(data) > self._memory_limit:
+            self._file = tempfile.TemporaryFile(dir=self._spill_dir, prefix='spark-output-')
+            self._file.write(self._mem)
+            self._mem = bytearray()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._mem += data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._mem = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        '''Total amount of captured bytes.'''
+        return self._size
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def _read(self, offset: int, length: int) -> bytes:
+        if self._file is None:
+            return bytes(self._mem[offset : offset + length])
+        self._file.flush()
+        return os.pread(self._file.fileno(), length, offset)
+
+    def _iter_bytes(self, offset: int = 0):
+        while offset < self._size:
+            data = self._read(offset, self.READ_SIZE)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+    def _iter_lines_from(self, offset: int):
+        partial: list[bytes] = []
+        for data in self._iter_bytes(offset):
+            lines = data.split(b'\n')
+            if partial:
+                partial.append(lines[0])
+                lines[0] = b''.join(partial)
+                partial = []
+            tail = lines.pop()
+            if tail:
+                partial.append(tail)
+            for line in lines:
+                yield str(line, 'utf-8', 'replace')
+        if partial:
+            yield str(b''.join(partial), 'utf-8', 'replace')
+
+    def __iter__(self):
+        '''Iterate over all captured lines (without line terminators).'''
+        return self._iter_lines_from(0)
+
+    def __len__(self) -> int:
+        '''Number of captured lines.'''
+        if self._size == 0:
+            return 0
+        return self._newlines + (0 if self._last_byte == b'\n' else 1)
+
+    def _line_offset(self, index: int) -> int:
+        if index == 0:
+            return 0
+        # find the last chunk that starts before the newline terminating the previous line
+        pos = bisect.bisect_left(self._idx_newlines, index) - 1
+        offset = self._idx_offsets[pos]
+        remaining = index - self._idx_newlines[pos]
+        for data in self._iter_bytes(offset):
+            count = data.count(b'\n')
+            if count < remaining:
+                remaining -= count
+                offset += len(data)
+                continue
+            nl = -1
+            for _ in range(remaining):
+                nl = data.index(b'\n', nl + 1)
+            return offset + nl + 1
+        raise IndexError('line index out of range')
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('line index out of range')
+        return next(self._iter_lines_from(self._line_offset(index)))
+
+    def lines(self, start: int = 0):
+        '''Iterate over the captured lines, beginning at line :start.'''
+        if start >= len(self):
+            return iter(())
+        return self._iter_lines_from(self._line_offset(max(start, 0)))
+
+    def tail(self, count: int) -> str:
+        '''Return the last :count lines as a single string.'''
+        return '\n'.join(self.lines(len(self) - count))
+
+    def getvalue(self) -> str:
+        '''Return all output as a string. Avoid this for potentially large output.'''
+        return str(b''.join(self._iter_bytes()), 'utf-8', 'replace')
+
+    def __str__(self):
+        return self.getvalue()
+
+
+def run_logged(jlog, cmd: list[str], return_output=False, *, line_handlers=None, **kwargs):
     '''Run a command and log output to the job logfile.
 
     Parameters
@@ -87,14 +388,19 @@ def run_logged(jlog, cmd: list[str], return_output=False, **kwargs):
     cmd
         Command to execute
     return_output
-        Whether to save the output to return as string when the function completes.
+        Whether to capture the output to return it when the function completes.
+    line_handlers
+        Optional list of callables which are invoked with every line of output (as bytes).
+        A handler may raise :class:`AbortCommand` to terminate the command early.
 
     Returns
     -------
     ret : int
         Return code of the process
-    outbuf : str or None
-        Process output as string if `return_output` was True
+    output : OutputCapture or None
+        Captured process output if `return_output` was True.
+        Output exceeding the memory budget is kept in a temporary file in the
+        current directory (or `cwd`, if set).
     '''
     p = subprocess.Popen(
         cmd, **kwargs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False
@@ -102,18 +408,18 @@ def run_logged(jlog, cmd: list[str], return_output=False, **kwargs):
 
     # capture live output and send it to all places that are interested in
     # logging it (except for our stdout).
-    outbuf = StringIO()
-    while True:
-        line_b = p.stdout.readline()
-        if p.poll() is not None:
-            break
-        line_s = str(line_b, 'utf-8', 'replace')
-        jlog.write(line_s)
-        if return_output:
-            outbuf.write(line_s)
-
-    ret = p.returncode
-    if ret:
-        jlog.write('Command {0} failed with error code {1}'.format(' '.join(cmd), ret))
-
-    return ret, outbuf.getvalue()
+    pump = OutputPump(sinks=[jlog], line_handlers=line_handlers)
+    capture = None
+    if return_output:
+        capture = OutputCapture(spill_dir=kwargs.get('cwd'))
+        pump.add_sink(capture)
+    with p.stdout:
+        pump.run(p.stdout.fileno(), p)
+
+    ret = p.wait()
+    if pump.abort_reason:
+        jlog.write('Command {0} was terminated: {1}\n'.format(' '.join(cmd), pump.abort_reason))
+    elif ret:
+        jlog.write('Command {0} failed with error code {1}\n'.format(' '.join(cmd), ret))
+
+    return ret, capture
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+import base64
+
+try:
+    from compression import zstd
+
+    _zstd_compress = zstd.compress
+except ImportError:
+    try:
+        import zstandard
+
+        _zstd_compress = zstandard.ZstdCompressor(level=3).compress
+    except ImportError:
+        _zstd_compress = None
+
+# don't bother compressing anything smaller than this
+MIN_COMPRESS_SIZE = 256
+
+
+def supported_methods() -> list[str]:
+    '''
+    List of compression methods we can use for log excerpts, most preferred first.
+    '''
+    if _zstd_compress is not None:
+        return ['zstd', 'zlib']
+    return ['zlib']
+
+
+def _compress(method: str, data: bytes) -> bytes:
+    if method == 'zlib':
+        return zlib.compress(data, 6)
+    if method == 'zstd' and _zstd_compress is not None:
+        return _zstd_compress(data)
+    raise ValueError('Unsupported compression method: {}'.format(method))
+
+
+def encode_text(text: str, method: str | None) -> tuple[str, str | None, int, int]:
+    '''
+    Compress text for transmission in a JSON message using :method, if that is worth it.
+
+    Returns
+    -------
+    payload : str
+        The encoded payload (or the unchanged text)
+    encoding : str or None
+        Encoding of the payload, e.g. "zlib+base64", or None if it was not compressed
+    raw_size : int
+        Size of the UTF-8 encoded text
+    wire_size : int
+        Size of the payload
+    '''
+    raw = text.encode('utf-8')
+    if not method or len(raw) < MIN_COMPRESS_SIZE:
+        return text, None, len(raw), len(raw)
+
+    payload = base64.b64encode(_compress(method, raw))
+    if len(payload) >= len(raw):
+        return text, None, len(raw), len(raw)
+    return str(payload, 'ascii'), '{}+base64'.format(method), len(raw), len(payload)
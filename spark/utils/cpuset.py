@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import glob
+import shutil
+
+# the CPUs the job running in this process may use, None if it is not restricted
+_job_cpus: list[int] | None = None
+
+
+def parse_cpu_list(text: str) -> list[int]:
+    '''Parse a CPU list in the kernel's format, e.g. "0-3,8,10-11".'''
+    cpus: list[int] = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus: list[int]) -> str:
+    '''Format CPU numbers as a CPU list in the kernel's format.'''
+    ranges: list[list[int]] = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def numa_nodes() -> list[list[int]]:
+    '''
+    CPUs we are allowed to run on, grouped by NUMA node.
+    Machines without NUMA information are treated as a single node.
+    '''
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    node_dirs = glob.glob('/sys/devices/system/node/node[0-9]*')
+    for node_dir in sorted(node_dirs, key=lambda d: int(os.path.basename(d)[4:])):
+        try:
+            with open(os.path.join(node_dir, 'cpulist'), 'r', encoding='utf-8') as f:
+                cpus = [c for c in parse_cpu_list(f.read()) if c in allowed]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    if sum(len(n) for n in nodes) != len(allowed):
+        return [sorted(allowed)]
+    return nodes
+
+
+def _chunks(cpus: list[int], count: int) -> list[list[int]]:
+    return [cpus[len(cpus) * i // count : len(cpus) * (i + 1) // count] for i in range(count)]
+
+
+def split_cpus(nodes: list[list[int]], parts: int) -> list[list[int]]:
+    '''
+    Split the CPUs of :nodes into :parts sets of about the same size, none of which
+    spans multiple NUMA nodes unless there are fewer parts than nodes.
+    '''
+    flat = [c for n in nodes for c in n]
+    if parts > len(flat):
+        # more parts than CPUs - some have to share
+        return [[flat[i % len(flat)]] for i in range(parts)]
+    if parts < len(nodes):
+        return _chunks(flat, parts)
+
+    # every node gets a number of parts proportional to its amount of CPUs
+    alloc = [1] * len(nodes)
+    for _ in range(parts - len(nodes)):
+        i = max(range(len(nodes)), key=lambda i: len(nodes[i]) / alloc[i])
+        alloc[i] += 1
+    sets = []
+    for node, count in zip(nodes, alloc):
+        sets.extend(_chunks(node, count))
+    return sets
+
+
+def set_job_cpus(cpus: list[int] | None):
+    '''Restrict commands of the current job to :cpus.'''
+    global _job_cpus  # pylint: disable=global-statement
+    _job_cpus = cpus
+
+
+def job_cpus() -> list[int] | None:
+    '''Get the CPUs the current job may use, None if it is not restricted.'''
+    return _job_cpus
+
+
+def pinned_command(cmd: list[str]) -> list[str]:
+    '''Make :cmd run on the CPUs of the current job only, if it is restricted.'''
+    if not _job_cpus or not shutil.which('taskset'):
+        return cmd
+    return ['taskset', '--cpu-list', format_cpu_list(_job_cpus)] + cmd
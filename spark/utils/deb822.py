@@ -20,11 +20,12 @@
 # DEALINGS IN THE SOFTWARE.
 
 import os
-import hashlib
 
 from debian.deb822 import Changes as Changes_
 from debian.deb822 import _gpg_multivalued
 
+from spark.utils.digest import DigestCache, FileDigests, digest_files, file_digests
+
 
 # Copy of debian.deb822.Dsc with Package-List: support added.
 class Dsc(_gpg_multivalued):
@@ -39,34 +40,39 @@ class Dsc(_gpg_multivalued):
 # Extention to debian.deb822.Changes with add_file() support
 # Also useful for Debile *.dud files.
 class Changes(Changes_):
-    def add_file(self, fp):
-        statinfo = os.stat(fp)
-        size = statinfo.st_size
-
-        algos = {
-            "Files": "md5",
-            "Checksums-Sha1": "sha1",
-            "Checksums-Sha256": "sha256",
-        }
-
-        for key, algo in algos.items():
+    def _append_file(self, fp, digests: FileDigests):
+        for key in ("Files", "Checksums-Sha1", "Checksums-Sha256"):
             if key not in self:
-                self[key] = []
+                self[key] = []  # type: ignore[assignment]
+
+        self["Files"].append(
+            {
+                "md5sum": digests.md5,
+                "size": digests.size,
+                "section": 'spark',
+                "priority": 'spark',
+                "name": fp,
+            }
+        )
+        self["Checksums-Sha1"].append({"sha1": digests.sha1, "size": digests.size, "name": fp})
+        self["Checksums-Sha256"].append(
+            {"sha256": digests.sha256, "size": digests.size, "name": fp}
+        )
 
-            m = hashlib.new(algo)
-            with open(fp, "rb") as fd:
-                for chunk in iter((lambda fd=fd, m=m: fd.read(128 * m.block_size)), b''):
-                    m.update(chunk)
+    def add_file(self, fp, cache: DigestCache | None = None, basedir=None):
+        path = os.path.join(basedir, fp) if basedir else fp
+        if cache:
+            self._append_file(fp, cache.digest_files([path])[0])
+        else:
+            self._append_file(fp, file_digests(path))
 
-            if key != "Files":
-                self[key].append({algo: m.hexdigest(), "size": size, "name": fp})
-            else:
-                self[key].append(
-                    {
-                        "md5sum": m.hexdigest(),
-                        "size": size,
-                        "section": 'spark',
-                        "priority": 'spark',
-                        "name": fp,
-                    }
-                )
+    def add_files(self, fps, cache: DigestCache | None = None, basedir=None):
+        """
+        Add multiple files, calculating their checksums in parallel.
+        Relative names are looked up in :basedir, if set.
+        """
+        fps = list(fps)
+        paths = [os.path.join(basedir, fp) for fp in fps] if basedir else fps
+        digests_list = cache.digest_files(paths) if cache else digest_files(paths)
+        for fp, digests in zip(fps, digests_list):
+            self._append_file(fp, digests)
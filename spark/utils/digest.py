@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import hashlib
+import logging as log
+import threading
+from typing import NamedTuple
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# checksum algorithms we need for .changes/.dud files
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+# size of a single read, a multiple of the page size
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+# files larger than this are mapped into memory instead of being read()
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# upper limit for the amount of files hashed in parallel
+MAX_DIGEST_WORKERS = 4
+
+
+class FileDigests(NamedTuple):
+    """Size and checksums of a file."""
+
+    size: int
+    md5: str
+    sha1: str
+    sha256: str
+
+
+def _feed_mapped(fd: int, size: int, hashers):
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            for offset in range(0, size, READ_CHUNK_SIZE):
+                chunk = view[offset : offset + READ_CHUNK_SIZE]
+                for m in hashers:
+                    m.update(chunk)
+                chunk.release()
+        finally:
+            view.release()
+
+
+def _feed_read(f, hashers):
+    buf = bytearray(READ_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        for m in hashers:
+            m.update(view[:n])
+
+
+def file_digests(fname: str | os.PathLike) -> FileDigests:
+    '''
+    Calculate all checksums of a file, reading its data only once.
+    '''
+    hashers = [hashlib.new(algo) for algo in DIGEST_ALGORITHMS]
+    with open(fname, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if size >= MMAP_THRESHOLD:
+            _feed_mapped(fd, size, hashers)
+        else:
+            _feed_read(f, hashers)
+
+    return FileDigests(size, *[m.hexdigest() for m in hashers])
+
+
+def digest_files(fnames, max_workers: int | None = None) -> list[FileDigests]:
+    '''
+    Calculate the checksums of multiple files in parallel.
+    The result list has the same order as :fnames.
+    '''
+    fnames = list(fnames)
+    if not fnames:
+        return []
+    if not max_workers:
+        max_workers = min(len(fnames), os.cpu_count() or 1, MAX_DIGEST_WORKERS)
+
+    start_time = time.monotonic()
+    if max_workers <= 1:
+        results = [file_digests(fname) for fname in fnames]
+    else:
+        # hashlib releases the GIL while hashing large buffers, so threads are sufficient here
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='digest') as executor:
+            results = list(executor.map(file_digests, fnames))
+    duration = time.monotonic() - start_time
+
+    total_bytes = sum(d.size for d in results)
+    log.info(
+        'Hashed {0} file(s), {1:.1f} MiB in {2:.2f}s ({3:.1f} MiB/s, {4} thread(s))'.format(
+            len(fnames),
+            total_bytes / (1024 * 1024),
+            duration,
+            total_bytes / (1024 * 1024) / max(duration, 0.001),
+            max_workers,
+        )
+    )
+
+    return results
+
+
+def _stat_key(st: os.stat_result) -> str:
+    return '{0}:{1}:{2}:{3}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class DigestCache:
+    '''
+    Persistent cache of file checksums.
+
+    Entries are keyed by device, inode, size and modification time of a file,
+    so any change to a file results in a cache miss. The cache file may be shared
+    between multiple processes, writes are serialized with a lock and merged.
+    Instances may be used by multiple threads.
+    '''
+
+    # files modified less than this amount of nanoseconds before they were hashed
+    # are not cached, as they could be changed again without altering their mtime
+    RACY_WINDOW_NS = 1_000_000_000
+
+    def __init__(self, fname: str, max_entries: int = 4096):
+        self._fname = fname
+        self._max_entries = max(max_entries, 1)
+        self._entries: OrderedDict[str, list] = OrderedDict()
+        self._dirty = False
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.RLock()
+        self._load()
+
+    def _read_entries(self) -> OrderedDict[str, list]:
+        entries: OrderedDict[str, list] = OrderedDict()
+        try:
+            with open(self._fname, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return entries
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring broken digest cache {0}: {1}'.format(self._fname, str(e)))
+            return entries
+
+        # entries are stored as [key, last_used, size, md5, sha1, sha256], least recently used first
+        for entry in data.get('entries', []):
+            if len(entry) != 6:
+                continue
+            entries[entry[0]] = entry[1:]
+        return entries
+
+    def _load(self):
+        self._entries = self._read_entries()
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self._fname), exist_ok=True)
+        with open(self._fname + '.lock', 'w', encoding='utf-8') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def save(self):
+        '''
+        Merge our entries with the ones on disk and write the result back.
+        '''
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self._dirty:
+            return
+        with self._locked():
+            merged = self._read_entries()
+            for key, value in self._entries.items():
+                other = merged.get(key)
+                if other is None or other[0] < value[0]:
+                    merged[key] = value
+
+            # evict least recently used entries
+            ordered = sorted(merged.items(), key=lambda kv: kv[1][0])
+            ordered = ordered[-self._max_entries :]
+            self._entries = OrderedDict(ordered)
+
+            data = {'entries': [[key] + value for key, value in self._entries.items()]}
+            tmp_fname = self._fname + '.new'
+            with open(tmp_fname, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_fname, self._fname)
+        self._dirty = False
+
+    def lookup(self, st: os.stat_result) -> FileDigests | None:
+        '''
+        Find the checksums for the file described by stat result :st.
+        '''
+        key = _stat_key(st)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None or value[1] != st.st_size:
+                self._misses += 1
+                return None
+            self._hits += 1
+            value[0] = time.time()
+            self._entries.move_to_end(key)
+            self._dirty = True
+            return FileDigests(*value[1:])
+
+    def store(self, st: os.stat_result, digests: FileDigests, hash_start_ns: int):
+        '''
+        Remember checksums of a file which was described by :st before hashing began.
+        '''
+        if digests.size != st.st_size:
+            return
+        if hash_start_ns - st.st_mtime_ns < self.RACY_WINDOW_NS:
+            return
+        key = _stat_key(st)
+        with self._lock:
+            self._entries[key] = [time.time()] + list(digests)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def digest_files(self, fnames) -> list[FileDigests]:
+        '''
+        Get the checksums of multiple files, only hashing files we do not know yet.
+        '''
+        fnames = list(fnames)
+        results: list[FileDigests | None] = []
+        stats: dict[int, os.stat_result] = {}
+        for i, fname in enumerate(fnames):
+            st = os.stat(fname)
+            stats[i] = st
+            results.append(self.lookup(st))
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            # files still within the racy window are not cached by store(), they are
+            # hashed again the next time instead of waiting for the window to pass
+            hash_start_ns = time.time_ns()
+            computed = digest_files([fnames[i] for i in missing])
+            for i, digests in zip(missing, computed):
+                results[i] = digests
+                # only cache the result if the file did not change while we were reading it
+                if _stat_key(os.stat(fnames[i])) == _stat_key(stats[i]):
+                    self.store(stats[i], digests, hash_start_ns)
+
+        log.debug(
+            'Digest cache: {0} hit(s), {1} miss(es) in total'.format(self._hits, self._misses)
+        )
+        try:
+            self.save()
+        except OSError as e:
+            log.warning('Unable to save digest cache {0}: {1}'.format(self._fname, str(e)))
+
+        return results
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import logging as log
+from contextlib import contextmanager
+
+from spark.utils.command import safe_run
+
+
+class GitMirrorCache:
+    '''
+    Local bare mirrors of Git repositories, shared by all worker processes.
+
+    Checkouts are created as local clones of an up-to-date mirror, which shares
+    the mirror's object files via hardlinks instead of transferring them over the
+    network again. Mirrors are updated while holding an exclusive lock, and cloned
+    from while holding a shared one. Mirrors nobody used for a while are removed.
+    '''
+
+    # interval (in seconds) to look for unused mirrors in
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, cache_dir: str, max_age: float):
+        self._cache_dir = cache_dir
+        self._max_age = max_age
+        self._last_prune = 0.0
+
+    def _mirror_dir(self, url: str) -> str:
+        return os.path.join(
+            self._cache_dir, '{}.git'.format(hashlib.sha256(url.encode('utf-8')).hexdigest())
+        )
+
+    @contextmanager
+    def _locked(self, mirror_dir: str, mode: int):
+        with open(mirror_dir + '.lock', 'w', encoding='utf-8') as lock_f:
+            fcntl.flock(lock_f, mode)
+            try:
+                yield lock_f
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _update_mirror(self, url: str, mirror_dir: str):
+        if os.path.isdir(mirror_dir):
+            safe_run(['git', '-C', mirror_dir, 'fetch', '--prune', '--quiet', 'origin'])
+            return
+
+        tmp_dir = mirror_dir + '.new'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        safe_run(['git', 'clone', '--mirror', '--quiet', url, tmp_dir])
+        os.rename(tmp_dir, mirror_dir)
+
+    def clone(self, url: str, dest: str):
+        '''Create a checkout of the default branch of :url at :dest.'''
+        os.makedirs(self._cache_dir, exist_ok=True)
+        mirror_dir = self._mirror_dir(url)
+        start_time = time.monotonic()
+        with self._locked(mirror_dir, fcntl.LOCK_EX) as lock_f:
+            self._update_mirror(url, mirror_dir)
+            # allow others to clone from the mirror while we do the same
+            fcntl.flock(lock_f, fcntl.LOCK_SH)
+            os.utime(mirror_dir)
+            safe_run(['git', 'clone', '--local', '--quiet', mirror_dir, dest])
+        safe_run(['git', '-C', dest, 'remote', 'set-url', 'origin', url])
+        log.info(
+            'Cloned {0} from local mirror in {1:.1f}s'.format(url, time.monotonic() - start_time)
+        )
+
+        if time.monotonic() - self._last_prune > self.PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self):
+        '''Remove mirrors which were not used in a long time.'''
+        self._last_prune = time.monotonic()
+        try:
+            entries = list(os.scandir(self._cache_dir))
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for entry in entries:
+            if not entry.name.endswith('.git') or not entry.is_dir():
+                continue
+            if now - entry.stat().st_mtime < self._max_age:
+                continue
+            with open(entry.path + '.lock', 'w', encoding='utf-8') as lock_f:
+                try:
+                    fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # the mirror is in use
+                    continue
+                log.info('Removing unused Git mirror %s', entry.name)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+_git_cache: GitMirrorCache | None = None
+
+
+def configure_git_cache(cache_dir: str, max_age: float):
+    '''Set up the Git mirror cache used by runners. A :max_age of 0 disables caching.'''
+    global _git_cache  # pylint: disable=global-statement
+    _git_cache = GitMirrorCache(cache_dir, max_age) if max_age > 0 else None
+
+
+def git_cache() -> GitMirrorCache | None:
+    '''Get the Git mirror cache, if caching is enabled.'''
+    return _git_cache
+
+
+def git_clone(url: str, dest: str):
+    '''Clone :url to :dest, through the mirror cache if possible.'''
+    cache = git_cache()
+    if cache:
+        try:
+            cache.clone(url, dest)
+            return
+        except Exception as e:
+            log.warning('Unable to clone %s via local mirror, cloning directly: %s', url, str(e))
+            shutil.rmtree(dest, ignore_errors=True)
+    safe_run(['git', 'clone', '--depth=1', url, dest])
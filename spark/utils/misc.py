@@ -19,8 +19,11 @@
 
 import os
 import json
+import random
 import shutil
+import logging as log
 import tempfile
+import multiprocessing as mp
 from contextlib import contextmanager
 
 from spark.utils.command import safe_run
@@ -34,9 +37,13 @@ def sign(changes, gpg):
         safe_run(['debsign', '-k', gpg, changes])
 
 
+def dput(changes, host, config_file):
+    return safe_run(['dput', '-c', config_file, host, changes])
+
+
 def upload(changes, gpg, host, config_file):
     sign(changes, gpg)
-    return safe_run(['dput', '-c', config_file, host, changes])
+    return dput(changes, host, config_file)
 
 
 @contextmanager
@@ -64,3 +71,85 @@ def to_compact_json(json_object, sort_keys=False):
     '''
     data = json.dumps(json_object, ensure_ascii=False, separators=(',', ':'), sort_keys=sort_keys)
     return str(data)
+
+
+def pressure_avg10(resource: str) -> float | None:
+    '''
+    Share of time (in percent, averaged over 10 seconds) in which some tasks were
+    stalled on :resource ("cpu", "io" or "memory"), or None if the kernel does not
+    provide pressure information.
+    '''
+    try:
+        with open(os.path.join('/proc/pressure', resource), 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    values = dict(v.split('=', 1) for v in fields[1:])
+                    return float(values['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+class Backoff:
+    '''
+    Exponentially growing delays with random jitter.
+    '''
+
+    def __init__(self, initial: float, maximum: float, factor: float = 2.0, jitter: float = 0.2):
+        self._initial = initial
+        self._maximum = maximum
+        self._factor = factor
+        self._jitter = jitter
+        self._current = initial
+
+    def reset(self):
+        self._current = self._initial
+
+    def next(self) -> float:
+        '''Get the next delay to wait for, in seconds.'''
+        delay = self._current
+        self._current = min(self._current * self._factor, self._maximum)
+        return delay * random.uniform(1.0 - self._jitter, 1.0 + self._jitter)
+
+
+class SlotLock:
+    '''
+    Lock shared by the worker processes, which remembers the job slot holding it,
+    so it can be taken over if the worker of that slot died while holding it.
+    '''
+
+    # time (in seconds) to wait for the lock before checking whether a dead worker holds it
+    TAKEOVER_TIMEOUT = 10.0
+
+    def __init__(self):
+        self._lock = mp.Lock()
+        self._owner = mp.Value('i', -1, lock=False)
+
+    @contextmanager
+    def held(self, slot: int = -1):
+        '''Hold the lock on behalf of the worker of :slot.'''
+        self._lock.acquire()
+        self._owner.value = slot
+        try:
+            yield
+        finally:
+            self._owner.value = -1
+            self._lock.release()
+
+    @contextmanager
+    def held_for_dead(self, slot: int):
+        '''
+        Hold the lock on behalf of the dead worker of :slot, taking it over if
+        that worker died while holding it.
+        '''
+        while not self._lock.acquire(timeout=self.TAKEOVER_TIMEOUT):
+            if self._owner.value == slot:
+                log.warning('Taking over a lock held by the dead worker of slot %d', slot)
+                break
+        self._owner.value = slot
+        try:
+            yield
+        finally:
+            self._owner.value = -1
+            self._lock.release()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import uuid
+import fcntl
+import shutil
+import logging as log
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from spark.utils.misc import pressure_avg10
+
+# name of the directory discarded trees are moved to, next to the tree itself
+TRASH_DIR_NAME = '.trash'
+
+# flags to open a directory we are about to empty with
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+
+# set whenever a tree was moved to the trash, to wake up the reapers of this process
+_trash_event = threading.Event()
+
+
+def trash_dir_for(path: str) -> str:
+    '''Get the trash directory a tree at :path is moved to when discarded.'''
+    return os.path.join(os.path.dirname(os.path.normpath(path)), TRASH_DIR_NAME)
+
+
+def discard_tree(path: str):
+    '''
+    Move the directory tree at :path out of the way, to be removed by a reaper
+    in the background. This is a cheap rename, no matter how large the tree is.
+    '''
+    trash_dir = trash_dir_for(path)
+    dest = os.path.join(
+        trash_dir, '{}-{}'.format(os.path.basename(os.path.normpath(path)), uuid.uuid4().hex[:12])
+    )
+    try:
+        os.makedirs(trash_dir, exist_ok=True)
+        os.rename(path, dest)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        log.warning('Unable to move %s to the trash, removing it directly: %s', path, str(e))
+        shutil.rmtree(path)
+        return
+    _trash_event.set()
+
+
+def discard_stale_trees(parent_dir: str) -> int:
+    '''
+    Move everything in :parent_dir to its trash directory.
+    Returns the number of discarded trees.
+    '''
+    try:
+        entries = [e for e in os.scandir(parent_dir) if e.name != TRASH_DIR_NAME]
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            discard_tree(entry.path)
+        else:
+            os.unlink(entry.path)
+    return len(entries)
+
+
+class _ReaperStopped(Exception):
+    pass
+
+
+class Reaper:
+    '''
+    Remove directory trees from a trash directory in the background.
+
+    Each tree in the trash is claimed with a lock on its directory, so reapers of
+    several processes can work on the same trash directory. A tree is split into
+    its subtrees a few levels down, and those are removed in parallel, using
+    file descriptor relative operations to avoid resolving long paths over and
+    over again. When the system is under I/O pressure, removal is slowed down to
+    not get in the way of running builds.
+    Anything left when the reaper stops is picked up again on its next start.
+    '''
+
+    # interval (in seconds) to look for trees discarded by other processes in
+    RESCAN_INTERVAL = 300
+
+    # directory levels of a tree below which subtrees are removed in parallel
+    SPLIT_DEPTH = 2
+
+    # number of removals between checks for I/O pressure
+    THROTTLE_CHECK_COUNT = 512
+
+    # time (in seconds) to pause when the system is under I/O pressure
+    THROTTLE_PAUSE = 1.0
+
+    def __init__(self, trash_dir: str, threads: int = 4, io_pressure_limit: float = 10.0):
+        self._trash_dir = trash_dir
+        self._threads = max(threads, 1)
+        self._io_pressure_limit = io_pressure_limit
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pool: ThreadPoolExecutor | None = None
+
+        self._pressure_lock = threading.Lock()
+        self._pressure_checked = 0.0
+        self._pressure: float | None = None
+
+    def start(self):
+        '''Start removing trees in the background, beginning with anything left over.'''
+        if self._thread:
+            return
+        self._stop_event.clear()
+        self._pool = ThreadPoolExecutor(self._threads, thread_name_prefix='reaper')
+        self._thread = threading.Thread(target=self._run, name='reaper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        '''Stop the reaper, leaving trees which were not removed yet in the trash.'''
+        if not self._thread:
+            return
+        self._stop_event.set()
+        _trash_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+        if self._pool:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            _trash_event.clear()
+            try:
+                self._reap_all()
+            except _ReaperStopped:
+                break
+            except Exception as e:
+                log.error('Error while removing discarded trees: %s', str(e))
+            _trash_event.wait(self.RESCAN_INTERVAL)
+
+    def _reap_all(self):
+        try:
+            entries = list(os.scandir(self._trash_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            self._check_stop()
+            try:
+                self._reap(entry.path)
+            except _ReaperStopped:
+                raise
+            except Exception as e:
+                log.error('Unable to remove discarded tree %s: %s', entry.name, str(e))
+
+    def _reap(self, path: str):
+        try:
+            fd = os.open(path, _DIR_FLAGS)
+        except FileNotFoundError:
+            return
+        except OSError:
+            # not a directory
+            os.unlink(path)
+            return
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another reaper is already busy with this tree
+                return
+
+            start_time = time.monotonic()
+            count = self._remove_split(path)
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                return
+            log.info(
+                'Removed {0} ({1} entries) in {2:.1f}s'.format(
+                    os.path.basename(path), count, time.monotonic() - start_time
+                )
+            )
+        finally:
+            os.close(fd)
+
+    def _remove_split(self, path: str) -> int:
+        '''Empty the directory :path, removing its subtrees in parallel.'''
+        assert self._pool
+        count = 0
+        shallow_dirs: list[str] = []
+        level = [path]
+        for _ in range(self.SPLIT_DEPTH):
+            next_level = []
+            for dir_path in level:
+                fd = os.open(dir_path, _DIR_FLAGS)
+                try:
+                    with os.scandir(fd) as it:
+                        entries = list(it)
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            next_level.append(os.path.join(dir_path, entry.name))
+                        else:
+                            self._remove_entry(fd, entry.name, False)
+                            count += 1
+                finally:
+                    os.close(fd)
+            shallow_dirs.extend(next_level)
+            level = next_level
+
+        futures = [self._pool.submit(self._remove_subtree, p) for p in level]
+        error = None
+        for future in futures:
+            try:
+                count += future.result()
+            except Exception as e:
+                error = e
+        if error:
+            raise error
+
+        # deepest directories come last
+        for dir_path in reversed(shallow_dirs):
+            try:
+                os.rmdir(dir_path)
+            except PermissionError:
+                os.chmod(os.path.dirname(dir_path), 0o700)
+                os.rmdir(dir_path)
+            count += 1
+        return count
+
+    def _remove_subtree(self, path: str) -> int:
+        fd = os.open(path, _DIR_FLAGS)
+        try:
+            return self._remove_contents(fd)
+        finally:
+            os.close(fd)
+
+    def _remove_contents(self, dir_fd: int) -> int:
+        with os.scandir(dir_fd) as it:
+            entries = [(e.name, e.is_dir(follow_symlinks=False)) for e in it]
+        count = 0
+        for name, is_dir in entries:
+            if is_dir:
+                try:
+                    fd = os.open(name, _DIR_FLAGS, dir_fd=dir_fd)
+                except PermissionError:
+                    os.chmod(name, 0o700, dir_fd=dir_fd)
+                    fd = os.open(name, _DIR_FLAGS, dir_fd=dir_fd)
+                try:
+                    count += self._remove_contents(fd)
+                finally:
+                    os.close(fd)
+            self._remove_entry(dir_fd, name, is_dir)
+            count += 1
+            if count % self.THROTTLE_CHECK_COUNT == 0:
+                self._throttle()
+        return count
+
+    def _remove_entry(self, dir_fd: int, name: str, is_dir: bool):
+        remove = os.rmdir if is_dir else os.unlink
+        try:
+            remove(name, dir_fd=dir_fd)
+        except PermissionError:
+            # the directory may have been made read-only by a build
+            os.chmod(dir_fd, 0o700)
+            remove(name, dir_fd=dir_fd)
+
+    def _check_stop(self):
+        if self._stop_event.is_set():
+            raise _ReaperStopped()
+
+    def _throttle(self):
+        '''Pause while the system is under I/O pressure.'''
+        while True:
+            self._check_stop()
+            with self._pressure_lock:
+                now = time.monotonic()
+                if now - self._pressure_checked >= self.THROTTLE_PAUSE:
+                    self._pressure = pressure_avg10('io')
+                    self._pressure_checked = now
+                pressure = self._pressure
+            if pressure is None or pressure <= self._io_pressure_limit:
+                return
+            self._stop_event.wait(self.THROTTLE_PAUSE)
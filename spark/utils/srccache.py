@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import stat
+import fcntl
+import hashlib
+import logging as log
+import tempfile
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+from spark.utils.deb822 import Dsc
+from spark.utils.staging import stage_file
+
+# size of a single read when downloading files
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# timeout (in seconds) for network operations
+DOWNLOAD_TIMEOUT = 120
+
+
+def download(url: str, fname: str) -> str:
+    '''Download :url to :fname and return the SHA-256 checksum of the data.'''
+    sha256 = hashlib.sha256()
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        with open(fname, 'wb') as f:
+            while True:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                f.write(chunk)
+    return sha256.hexdigest()
+
+
+class SourceCache:
+    '''
+    Content-addressed cache of source package files, shared by all worker processes.
+
+    Files are stored read-only under their SHA-256 checksum, as listed in the .dsc
+    file of a source package, and hardlinked into job workspaces. The .dsc file
+    itself is always downloaded, as it is small and tells us what the other files
+    have to look like. Once the cache grows larger than its size limit, the least
+    recently used files are removed.
+    '''
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._stats_fname = os.path.join(cache_dir, 'stats.json')
+
+    def _entry_fname(self, sha256: str) -> str:
+        return os.path.join(self._cache_dir, sha256[:2], sha256)
+
+    @contextmanager
+    def _locked(self, lock_fname: str, mode=fcntl.LOCK_EX):
+        while True:
+            lock_f = open(lock_fname, 'w', encoding='utf-8')
+            fcntl.flock(lock_f, mode)
+            try:
+                if os.stat(lock_fname).st_ino == os.fstat(lock_f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # the lock file was removed by eviction while we were waiting for it
+            lock_f.close()
+        with lock_f:
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _fetch_file(self, url: str, sha256: str, size: int) -> bool:
+        '''Make sure a file is in the cache. Returns True if it was there already.'''
+        entry_fname = self._entry_fname(sha256)
+        os.makedirs(os.path.dirname(entry_fname), exist_ok=True)
+        with self._locked(entry_fname + '.lock'):
+            try:
+                st = os.stat(entry_fname)
+                if st.st_size == size:
+                    # mark the file as recently used
+                    os.utime(entry_fname)
+                    return True
+                os.unlink(entry_fname)
+            except FileNotFoundError:
+                pass
+
+            fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(entry_fname), prefix='.dl-')
+            os.close(fd)
+            try:
+                digest = download(url, tmp_fname)
+                if digest != sha256:
+                    raise ValueError(
+                        'Checksum mismatch for {}: expected {}, got {}'.format(url, sha256, digest)
+                    )
+                os.chmod(tmp_fname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.rename(tmp_fname, entry_fname)
+            finally:
+                if os.path.exists(tmp_fname):
+                    os.unlink(tmp_fname)
+        return False
+
+    def fetch_source(self, dsc_url: str, dest_dir: str) -> str:
+        '''
+        Download a source package to :dest_dir, using cached files where possible.
+        Returns the filename of the .dsc file.
+        '''
+        os.makedirs(self._cache_dir, exist_ok=True)
+        dsc_fname = os.path.join(dest_dir, os.path.basename(urllib.parse.urlparse(dsc_url).path))
+        staged = [dsc_fname]
+        try:
+            return self._fetch_source(dsc_url, dsc_fname, dest_dir, staged)
+        except Exception:
+            # don't leave partial files behind for a download without the cache
+            for fname in staged:
+                try:
+                    os.unlink(fname)
+                except FileNotFoundError:
+                    pass
+            raise
+
+    def _fetch_source(self, dsc_url: str, dsc_fname: str, dest_dir: str, staged: list[str]) -> str:
+        download(dsc_url, dsc_fname)
+        with open(dsc_fname, 'r', encoding='utf-8') as f:
+            dsc = Dsc(f)
+        files = dsc.get('Checksums-Sha256')
+        if not files:
+            raise ValueError('No SHA-256 checksums found in {}'.format(dsc_url))
+
+        hits = 0
+        misses = 0
+        bytes_saved = 0
+        bytes_downloaded = 0
+        for entry in files:
+            name = entry['name']
+            size = int(entry['size'])
+            if os.path.basename(name) != name:
+                raise ValueError('Invalid file name in {}: {}'.format(dsc_url, name))
+            if self._fetch_file(urllib.parse.urljoin(dsc_url, name), entry['sha256'], size):
+                hits += 1
+                bytes_saved += size
+            else:
+                misses += 1
+                bytes_downloaded += size
+            staged.append(os.path.join(dest_dir, name))
+            stage_file(self._entry_fname(entry['sha256']), staged[-1])
+
+        self._update_stats(hits, misses, bytes_saved, bytes_downloaded)
+        log.info(
+            'Source cache: {0} hit(s), {1} miss(es) for {2}, {3:.1f} MiB not downloaded'.format(
+                hits, misses, os.path.basename(dsc_fname), bytes_saved / (1024 * 1024)
+            )
+        )
+        self.evict()
+        return dsc_fname
+
+    def _update_stats(self, hits: int, misses: int, bytes_saved: int, bytes_downloaded: int):
+        with self._locked(self._stats_fname + '.lock'):
+            stats = self.stats()
+            stats['hits'] += hits
+            stats['misses'] += misses
+            stats['bytes_saved'] += bytes_saved
+            stats['bytes_downloaded'] += bytes_downloaded
+            with open(self._stats_fname + '.new', 'w', encoding='utf-8') as f:
+                json.dump(stats, f)
+            os.replace(self._stats_fname + '.new', self._stats_fname)
+
+    def stats(self) -> dict[str, int]:
+        '''Accumulated statistics of all users of the cache.'''
+        stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'bytes_downloaded': 0}
+        try:
+            with open(self._stats_fname, 'r', encoding='utf-8') as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def evict(self):
+        '''Remove the least recently used files until the cache fits its size limit.'''
+        entries = []
+        total_size = 0
+        for subdir in os.scandir(self._cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.startswith('.') or entry.name.endswith('.lock'):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total_size += st.st_size
+        if total_size <= self._max_bytes:
+            return
+
+        entries.sort()
+        removed = 0
+        for mtime, size, fname in entries:
+            if total_size <= self._max_bytes:
+                break
+            with self._locked(fname + '.lock'):
+                try:
+                    if os.stat(fname).st_mtime != mtime:
+                        # the file was used while we were looking for candidates
+                        continue
+                    os.unlink(fname)
+                except FileNotFoundError:
+                    continue
+                # while we hold the lock, so anyone waiting for it notices and retries
+                os.unlink(fname + '.lock')
+            total_size -= size
+            removed += 1
+        log.info('Source cache: evicted {0} file(s)'.format(removed))
+
+
+_source_cache: SourceCache | None = None
+
+
+def configure_source_cache(cache_dir: str, max_bytes: int):
+    '''Set up the source cache used by runners. A :max_bytes of 0 disables caching.'''
+    global _source_cache  # pylint: disable=global-statement
+    _source_cache = SourceCache(cache_dir, max_bytes) if max_bytes > 0 else None
+
+
+def source_cache() -> SourceCache | None:
+    '''Get the source cache, if caching is enabled.'''
+    return _source_cache
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import fcntl
+import shutil
+import logging as log
+from enum import StrEnum
+
+# ioctl to share the data extents of a file (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+# errors which indicate that a method is not supported for the given files
+_UNSUPPORTED_ERRNOS = (
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EMLINK,
+)
+
+
+class StageMethod(StrEnum):
+    """Method used to place a file into the staging area"""
+
+    REFLINK = 'reflink'
+    HARDLINK = 'hardlink'
+    COPY_RANGE = 'copy_file_range'
+    COPY = 'copy'
+
+
+def _unlink_quiet(fname):
+    try:
+        os.unlink(fname)
+    except FileNotFoundError:
+        pass
+
+
+def _try_reflink(src: str, dest: str) -> bool:
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'xb') as fdest:
+            try:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                return True
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+    _unlink_quiet(dest)
+    return False
+
+
+def _try_hardlink(src: str, dest: str) -> bool:
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+    return False
+
+
+def _try_copy_range(src: str, dest: str) -> bool:
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'xb') as fdest:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            try:
+                while remaining > 0:
+                    n = os.copy_file_range(fsrc.fileno(), fdest.fileno(), min(remaining, 1 << 30))
+                    if n == 0:
+                        break
+                    remaining -= n
+                if remaining == 0:
+                    return True
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+    _unlink_quiet(dest)
+    return False
+
+
+def stage_file(src: str | os.PathLike, dest: str | os.PathLike) -> tuple[StageMethod, int]:
+    '''
+    Place a copy of :src at :dest, avoiding to duplicate the file data if possible.
+    We try to create a reflink first, then a hardlink, then let the kernel copy the
+    data and only resort to a plain copy if nothing else worked.
+    An existing file at :dest is replaced, unless it is :src itself.
+
+    Returns
+    -------
+    method : StageMethod
+        The method which was used to stage the file
+    saved : int
+        Amount of bytes which did not need to be copied
+    '''
+    src = os.fspath(src)
+    dest = os.fspath(dest)
+    size = os.stat(src).st_size
+
+    if os.path.lexists(dest):
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            # staged already, e.g. as a hardlink - opening it for writing would truncate :src
+            return StageMethod.HARDLINK, size
+        os.unlink(dest)
+
+    if _try_reflink(src, dest):
+        return StageMethod.REFLINK, size
+    if _try_hardlink(src, dest):
+        return StageMethod.HARDLINK, size
+    if hasattr(os, 'copy_file_range') and _try_copy_range(src, dest):
+        return StageMethod.COPY_RANGE, 0
+
+    shutil.copyfile(src, dest)
+    return StageMethod.COPY, 0
+
+
+class StagingReport:
+    """
+    Collect statistics on files placed into a staging area.
+    """
+
+    def __init__(self):
+        self._methods: dict[StageMethod, int] = {}
+        self._bytes_saved = 0
+        self._bytes_total = 0
+
+    def stage(self, src: str | os.PathLike, dest: str | os.PathLike) -> StageMethod:
+        method, saved = stage_file(src, dest)
+        self._methods[method] = self._methods.get(method, 0) + 1
+        self._bytes_saved += saved
+        self._bytes_total += os.stat(dest).st_size
+        return method
+
+    @property
+    def bytes_saved(self) -> int:
+        return self._bytes_saved
+
+    def log_summary(self, what: str):
+        if not self._methods:
+            return
+        methods = ', '.join('{}: {}'.format(m, n) for m, n in sorted(self._methods.items()))
+        log.info(
+            'Staged {0} ({1}), avoided copying {2:.1f} of {3:.1f} MiB'.format(
+                what,
+                methods,
+                self._bytes_saved / (1024 * 1024),
+                self._bytes_total / (1024 * 1024),
+            )
+        )
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016-2026 Matthias Klumpp <matthias@tenstral.net>
+#
+# Licensed under the GNU Lesser General Public License Version 3
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the license, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+from typing import NamedTuple
+
+from spark.utils.command import AbortCommand
+
+
+class LogTrigger(NamedTuple):
+    """A rule matching a line of command output."""
+
+    name: str
+    # regular expression (on bytes) a line has to match
+    pattern: bytes
+    # whether the command should be terminated once this rule matched
+    terminal: bool = False
+    # regular expression (on bytes) of a line after which this rule no longer applies,
+    # e.g. because the command entered a phase where the pattern means something else
+    until: bytes | None = None
+
+
+class LogTriggerMatcher:
+    '''
+    Match lines of command output against a table of rules.
+
+    All rules are compiled into a single regular expression, so each line is only
+    scanned once, no matter how many rules there are. Rules with an :until pattern
+    are dropped once a line matched it. Instances are used as line handlers for
+    :func:`spark.utils.command.run_logged`.
+    '''
+
+    def __init__(self, rules: list[LogTrigger]):
+        self._rules: dict[str, LogTrigger] = {}
+        for i, rule in enumerate(rules):
+            if re.compile(rule.pattern).groupindex:
+                raise ValueError(
+                    'Pattern of trigger "{}" must not contain named groups'.format(rule.name)
+                )
+            self._rules['t{}'.format(i)] = rule
+        self._until = [
+            (group, re.compile(rule.until)) for group, rule in self._rules.items() if rule.until
+        ]
+        self._compile()
+
+        self._fired: LogTrigger | None = None
+        self._fired_line: str | None = None
+        self._matches: dict[str, int] = {}
+
+    def _compile(self):
+        parts = [
+            b'(?P<%s>%s)' % (group.encode('ascii'), rule.pattern)
+            for group, rule in self._rules.items()
+        ]
+        self._regex = re.compile(b'|'.join(parts)) if parts else None
+
+    def __call__(self, line_b: bytes):
+        if self._until:
+            ended = [group for group, regex in self._until if regex.search(line_b)]
+            if ended:
+                for group in ended:
+                    del self._rules[group]
+                self._until = [(g, regex) for g, regex in self._until if g not in ended]
+                self._compile()
+        if self._regex is None:
+            return
+        m = self._regex.search(line_b)
+        if not m:
+            return
+        rule = self._rules[m.lastgroup]
+        self._matches[rule.name] = self._matches.get(rule.name, 0) + 1
+        if rule.terminal and self._fired is None:
+            self._fired = rule
+            self._fired_line = str(line_b, 'utf-8', 'replace')
+            raise AbortCommand('Matched "{}": {}'.format(rule.name, self._fired_line))
+
+    @property
+    def fired(self) -> str | None:
+        '''Name of the terminal rule which matched, if any.'''
+        return self._fired.name if self._fired else None
+
+    @property
+    def fired_line(self) -> str | None:
+        '''The output line which matched the terminal rule.'''
+        return self._fired_line
+
+    def match_count(self, name: str) -> int:
+        return self._matches.get(name, 0)
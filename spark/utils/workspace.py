@@ -26,6 +26,8 @@ from tempfile import NamedTemporaryFile
 from contextlib import contextmanager
 
 from spark import __appname__, __version__
+from spark.utils.cpuset import pinned_command
+from spark.utils.reaper import discard_tree
 from spark.utils.command import run_logged
 
 
@@ -41,23 +43,59 @@ class RunnerError(Exception):
     """Emitted by runners when execution fails unexpectedly."""
 
 
+class Workspace:
+    """A job workspace, as returned by :func:`lkworkspace`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.detached = False
+
+    def detach(self):
+        """
+        Keep the workspace when leaving its context.
+        Whoever detaches the workspace is responsible for removing it.
+        """
+        self.detached = True
+
+
+def slot_workspace(workspace_dir: str, slot: int, job_id: str) -> str:
+    """Path of the workspace for job :job_id run by job slot :slot."""
+    return os.path.join(workspace_dir, 'slot{}_{}'.format(slot, job_id))
+
+
+def discard_slot_workspaces(workspace_dir: str, slot: int) -> list[str]:
+    """
+    Discard the workspaces of all jobs of job slot :slot, after its worker died.
+    Returns the IDs of the jobs whose workspaces were discarded.
+    """
+    prefix = 'slot{}_'.format(slot)
+    try:
+        entries = [e for e in os.scandir(workspace_dir) if e.name.startswith(prefix)]
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        discard_tree(entry.path)
+    return [entry.name[len(prefix) :] for entry in entries]
+
+
 @contextmanager
 def lkworkspace(wsdir):
-    import shutil
-
     artifacts_dir = os.path.join(wsdir, 'artifacts')
     if not os.path.exists(artifacts_dir):
         os.makedirs(artifacts_dir)
 
+    ws = Workspace(wsdir)
     ncwd = os.getcwd()
     try:
-        yield os.chdir(wsdir)
+        os.chdir(wsdir)
+        yield ws
     finally:
         os.chdir(ncwd)
-        try:
-            shutil.rmtree(wsdir)
-        except Exception as e:
-            log.warning('Unable to remove stale workspace {0}: {1}'.format(wsdir, str(e)))
+        if not ws.detached:
+            try:
+                discard_tree(wsdir)
+            except Exception as e:
+                log.warning('Unable to remove stale workspace {0}: {1}'.format(wsdir, str(e)))
 
 
 @contextmanager
@@ -109,4 +147,4 @@ def debspawn_run_commandfile(
     ds_cmd.append(suite)
     ds_cmd.append(command_script)
 
-    return run_logged(jlog, ds_cmd, True)
+    return run_logged(jlog, pinned_command(ds_cmd))
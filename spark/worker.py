@@ -21,13 +21,36 @@ import os
 import time
 import shutil
 import logging as log
-from email.utils import formatdate
+import threading
+from enum import StrEnum
+from contextlib import nullcontext
 
-from spark.utils import RunnerResult
 from spark.config import LocalConfig
-from spark.joblog import job_log
+from spark.joblog import LogSender, job_log
+from spark.leases import JobLeaseQueue
+from spark.publish import Publisher, PublishTask
 from spark.runners import PLUGINS, load_module
-from spark.connection import JobStatus, ServerErrorException
+from spark.uploads import UploadQueue
+from spark.prefetch import Prefetcher
+from spark.scheduler import CpuPartitioner, AdmissionController
+from spark.connection import JobStatus, JobNotifier, ServerErrorException
+from spark.utils.misc import Backoff
+from spark.utils.cpuset import format_cpu_list
+from spark.utils.digest import DigestCache
+from spark.utils.reaper import TRASH_DIR_NAME, Reaper
+from spark.utils.compress import supported_methods as supported_compression_methods
+from spark.utils.gitcache import configure_git_cache
+from spark.utils.srccache import configure_source_cache
+
+
+class AcquireResult(StrEnum):
+    """Outcome of an attempt to get and run a job"""
+
+    DONE = 'done'  # a job was run
+    NO_JOBS = 'no-jobs'  # the server had no job for us
+    REJECTED = 'rejected'  # we received a job, but had to reject it
+    ERROR = 'error'  # communication with the server failed
+    REFUSED = 'refused'  # this machine lacks the resources for another job
 
 
 class Worker:
@@ -36,10 +59,70 @@ class Worker:
     calling the appropriate runner.
     """
 
-    def __init__(self, conf: LocalConfig, lighthouse_connection, is_primary: bool = True):
+    # delays (in seconds) before asking for a new job if the server had none for us
+    IDLE_POLL_MIN = 2.0
+    IDLE_POLL_MAX = 30.0
+
+    # delays (in seconds) before retrying after an error
+    ERROR_RETRY_MIN = 5.0
+    ERROR_RETRY_MAX = 300.0
+
+    # delay (in seconds) before asking for a new job after we rejected one
+    REJECT_RETRY_DELAY = 1.0
+
+    # delay (in seconds) before checking again whether we may take a job
+    ADMISSION_RETRY_DELAY = 10.0
+
+    # maximum time (in seconds) to wait for one event source while idle
+    WAIT_SLICE = 1.0
+
+    # interval (in seconds) in which the primary worker removes stale prefetched data
+    PREFETCH_PRUNE_INTERVAL = 3600.0
+
+    def __init__(
+        self,
+        conf: LocalConfig,
+        lighthouse_connection,
+        is_primary: bool = True,
+        primary_slot=None,
+        notifier: JobNotifier | None = None,
+        leases: JobLeaseQueue | None = None,
+        admission: AdmissionController | None = None,
+        cpus: CpuPartitioner | None = None,
+        slot: int = 0,
+    ):
         self._conn = lighthouse_connection
+        self._notifier = notifier
+        self._leases = leases
+        self._admission = admission
+        self._cpus = cpus
+        self._slot = slot
+        # whether the lease queue already counts us as busy with the job we fetched
+        self._marked_busy = False
+        self._stopping = False
         self._conf = conf
         self._is_primary = is_primary
+        self._primary_slot = primary_slot
+        self._acting_primary = False
+        self._next_prefetch_prune = 0.0
+        self._digest_cache = DigestCache(conf.digest_cache_fname, conf.digest_cache_entries)
+        self._log_sender = LogSender()
+        self._uploads = UploadQueue(conf, lighthouse_connection)
+        self._prefetcher = Prefetcher(conf.prefetch_dir)
+        self._reaper = Reaper(
+            os.path.join(conf.workspace_dir, TRASH_DIR_NAME),
+            threads=conf.reaper_threads,
+            io_pressure_limit=conf.reaper_max_io_pressure,
+        )
+        configure_source_cache(conf.source_cache_dir, conf.source_cache_max_bytes)
+        configure_git_cache(conf.git_cache_dir, conf.git_mirror_max_age)
+        self._publisher = Publisher(
+            lighthouse_connection,
+            self._uploads,
+            self._digest_cache,
+            max_in_flight=conf.max_publishes,
+            max_bytes=conf.max_publish_bytes,
+        )
 
     def _run_job(self, job):
         '''
@@ -47,9 +130,7 @@ class Worker:
         way and we did not reject it again.
         '''
 
-        from spark.utils.misc import cd, upload
-        from spark.utils.deb822 import Changes
-        from spark.utils.workspace import lkworkspace
+        from spark.utils.workspace import lkworkspace, slot_workspace
 
         # basic job information
         job_id = job.get('uuid')
@@ -58,7 +139,7 @@ class Worker:
             job_arch = 'all'
 
         # job workspace directories
-        workspace = os.path.join(self._conf.workspace_dir, job_id)
+        workspace = slot_workspace(self._conf.workspace_dir, self._slot, job_id)
         artifacts_dir = os.path.join(workspace, 'artifacts')
 
         # set up default workspace directories
@@ -80,6 +161,12 @@ class Worker:
                 pass  # we failed to create the workspace, so failing to clean it up is not an error
             return False
 
+        # use the job's inputs if we downloaded them ahead of time
+        try:
+            self._prefetcher.claim(job_id, workspace)
+        except OSError as e:
+            log.warning('Unable to use prefetched inputs of job %s: %s', job_id, str(e))
+
         # set the logfile and run the job
         log.info('Running job \'%s\'', job_id)
         log_fname = os.path.join(self._conf.job_log_dir, '{}.log'.format(job_id))
@@ -100,9 +187,20 @@ class Worker:
 
         self._conn.send_job_status(job_id, JobStatus.ACCEPTED)
 
+        # the server tells us which compression (if any) it accepts for log excerpts
+        log_compression = job.get('compression')
+        if log_compression not in supported_compression_methods():
+            log_compression = None
+
         run, _ = load_module(runner_name)
-        with lkworkspace(workspace):
-            with job_log(self._conn, job_id, log_fname) as jlog:
+        cpus = self._cpus.job_cpus(self._slot) if self._cpus else nullcontext(None)
+        with lkworkspace(workspace) as ws:
+            with (
+                job_log(self._conn, job_id, log_fname, self._log_sender, log_compression) as jlog,
+                cpus as job_cpus,
+            ):
+                if job_cpus:
+                    log.info('Running job \'%s\' on CPUs %s', job_id, format_cpu_list(job_cpus))
                 try:
                     build_result, files, changes = run(jlog, job, job.get('data'))
                 except:  # noqa: E722 pylint: disable=bare-except
@@ -116,80 +214,120 @@ class Worker:
                     return False
 
             # logfile is closed here
+            log.debug('Log sender statistics: %s', self._log_sender.stats())
+            log.debug('Lighthouse message statistics: %s', self._conn.message_stats())
+            log.debug('Outbox statistics: %s', self._conn.outbox_stats())
             if not files:
                 files = list()
-
-            # create directory with files to upload
-            if not os.path.exists(artifacts_dir):
-                os.makedirs(artifacts_dir)
-
-            with cd(artifacts_dir):
-                # write upload description file
-                # (upload additional artifacts which the runner hasn't dealt with,
-                # including the final logfile)
-                dud = Changes()
-                dud['Format'] = '1.8'
-                dud['Date'] = formatdate()
-                dud['Architecture'] = job_arch
-                dud['X-Spark-Job'] = str(job_id)
-                dud['X-Spark-Result'] = str(build_result)
-
-                # collect list of additional files to upload
-                files.append(log_fname)
-                for f in files:
-                    fbase = os.path.basename(f)
-                    if not os.path.isfile(fbase):
-                        shutil.copyfile(f, fbase)
-                    dud.add_file(fbase)
-
-                dudf = "{}.dud".format(job_id)
-                with open(dudf, 'wb') as fd:
-                    dud.dump(fd=fd)
-
-                # send the result to the remote server
-                try:
-                    if changes:
-                        upload(changes, self._conf.gpg_key_id, job_repo, self._conf._dput_cf_fname)
-                    upload(dudf, self._conf.gpg_key_id, job_repo, self._conf._dput_cf_fname)
-                except Exception as e:
-                    import sys
-
-                    print(e, file=sys.stderr)
-
-        jstatus = JobStatus.FAILED
-        if build_result == RunnerResult.SUCCESS:
-            jstatus = JobStatus.SUCCESS
-
-        self._conn.send_job_status(job_id, jstatus)
-        log.info('Finished job {0}, {1}'.format(job_id, str(jstatus)))
+            files.append(log_fname)
+
+            # hash, sign and upload the results in the background, while we go on
+            # with the next job
+            ws.detach()
+
+        task = PublishTask(
+            job_id=job_id,
+            arch=job_arch,
+            repo=job_repo,
+            workspace=workspace,
+            build_result=build_result,
+            files=[os.path.abspath(f) for f in files],
+            changes=os.path.abspath(changes) if changes else None,
+        )
+        self._publisher.submit(task)
 
         return True
 
-    def _request_job(self):
+    def _fetch_job(self) -> dict | None:
+        """
+        Get a job from the server, leasing jobs for other idle workers as well.
+        """
+        if self._leases is None:
+            return self._conn.request_job()
+
+        # jobs we leased already come first, the server considers them assigned to us
+        if len(self._leases) > 0:
+            job = self._leases.get(self._slot, timeout=self._leases.VISIBILITY_DELAY)
+            if job:
+                return job
+
+        # every job has to pass admission control on its own, so we can not lease
+        # jobs for other workers if we are checking the available resources
+        if self._admission:
+            return self._conn.request_job()
+
+        count = self._leases.reserve(self._slot)
+        if count == 0:
+            # other workers are requesting jobs for us already
+            return self._leases.get(self._slot, timeout=self.WAIT_SLICE)
+        jobs = []
+        try:
+            jobs = self._conn.request_jobs(count)
+            for job in jobs[1:]:
+                self._leases.put(self._slot, job)
+                # get the inputs of the job ready, so whoever runs it can start right away
+                self._prefetcher.start(job)
+        finally:
+            self._leases.release(self._slot, count, took_job=bool(jobs))
+            self._marked_busy = bool(jobs)
+        if not jobs:
+            return None
+        if len(jobs) > 1:
+            log.debug('Leased %d additional job(s) for other workers.', len(jobs) - 1)
+        return jobs[0]
+
+    def _request_job(self, job_reply: dict | None = None) -> 'AcquireResult':
         """
-        Request a new job.
+        Request a new job, unless we already got one from the lease queue.
         """
 
-        job_reply = None
+        if not self._admission:
+            return self._acquire_job(job_reply)
+
+        if not job_reply and not self._admission.admit(self._slot):
+            return AcquireResult.REFUSED
+        try:
+            return self._acquire_job(job_reply)
+        finally:
+            self._admission.release(self._slot)
+
+    def _acquire_job(self, job_reply: dict | None) -> 'AcquireResult':
         try:
-            job_reply = self._conn.request_job()
+            if not job_reply:
+                job_reply = self._fetch_job()
         except ServerErrorException as e:
             log.warning(str(e))
-            return False
+            return AcquireResult.ERROR
         except Exception as e:
             log.error('Error when requesting job: {}'.format(str(e)))
-            return False
+            return AcquireResult.ERROR
 
         if not job_reply:
             # there are no jobs available for us
-            return False
+            return AcquireResult.NO_JOBS
+
+        if self._leases is not None:
+            if not self._marked_busy:
+                self._leases.set_idle(self._slot, False)
+            self._marked_busy = False
+            try:
+                return self._handle_job(job_reply)
+            finally:
+                self._leases.set_idle(self._slot, True)
+        return self._handle_job(job_reply)
 
+    def _handle_job(self, job_reply: dict) -> 'AcquireResult':
         job_module = job_reply.get('module')
         job_kind = job_reply.get('kind')
         job_id = job_reply.get('uuid')
 
         if job_kind in self._conf.accepted_job_kinds:
-            return self._run_job(job_reply)
+            if self._admission:
+                self._admission.started(self._slot)
+            job_done = self._run_job(job_reply)
+            if job_done:
+                return AcquireResult.DONE
+            return AcquireResult.REJECTED
         else:
             log.warning(
                 'Received job of type {0}::{1} which we can not handle.'.format(
@@ -197,7 +335,7 @@ class Worker:
                 )
             )
             self._conn.send_job_status(job_id, JobStatus.REJECTED)
-            return False
+            return AcquireResult.REJECTED
 
     def _update_archive_data(self) -> bool:
         """
@@ -257,11 +395,108 @@ class Worker:
 
         # the primary worker is responsible for updating the dput.cf
         # file and store knowledge about the archive
-        if self._is_primary:
+        if self._primary():
             while not self._update_archive_data():
                 time.sleep(30)
+            self._acting_primary = True
+
+        # remove old workspaces and upload results of jobs in the background,
+        # including ones left over from a previous run
+        self._reaper.start()
+        self._uploads.start()
 
         # process jobs
-        while True:
-            if not self._request_job():
-                time.sleep(30)  # wait 30s before trying again
+        if self._leases is not None:
+            self._leases.set_idle(self._slot, True)
+        idle_backoff = Backoff(self.IDLE_POLL_MIN, self.IDLE_POLL_MAX)
+        error_backoff = Backoff(self.ERROR_RETRY_MIN, self.ERROR_RETRY_MAX)
+        job = None
+        while not self._stopping:
+            self._check_primary_role()
+            if self._leases is not None:
+                self._leases.report_orphans(self._conn)
+            result = self._request_job(job)
+            job = None
+            if result == AcquireResult.DONE:
+                # we just finished a job, so there may well be more - ask again immediately
+                idle_backoff.reset()
+                error_backoff.reset()
+                continue
+
+            if result == AcquireResult.ERROR:
+                delay = error_backoff.next()
+            else:
+                error_backoff.reset()
+                if result == AcquireResult.REJECTED:
+                    delay = self.REJECT_RETRY_DELAY
+                elif result == AcquireResult.REFUSED:
+                    delay = self.ADMISSION_RETRY_DELAY
+                else:
+                    delay = idle_backoff.next()
+
+            woken, job = self._wait_for_work(delay)
+            if woken:
+                idle_backoff.reset()
+
+        if self._leases is not None:
+            self._leases.return_all(self._slot, self._conn)
+        self._publisher.close()
+        self._uploads.stop()
+        self._reaper.stop()
+
+    def _primary(self) -> bool:
+        """Whether we currently have the primary role."""
+        if self._primary_slot is None:
+            return self._is_primary
+        return self._primary_slot.value == self._slot
+
+    def _check_primary_role(self):
+        """
+        Take over the duties of the primary worker if the role was moved to us,
+        because the previous primary worker is gone, and do the periodic ones.
+        """
+        if not self._primary():
+            self._acting_primary = False
+            return
+        if not self._acting_primary:
+            if not self._update_archive_data():
+                return
+            log.info('Took over the primary worker role.')
+            self._acting_primary = True
+
+        now = time.monotonic()
+        if now >= self._next_prefetch_prune:
+            self._next_prefetch_prune = now + self.PREFETCH_PRUNE_INTERVAL
+            self._prefetcher.prune()
+
+    def _wait_for_work(self, delay: float) -> tuple[bool, dict | None]:
+        """
+        Wait up to :delay seconds before asking for a new job.
+        Returns whether we were woken up early, and a leased job if one became available.
+        """
+        deadline = time.monotonic() + delay
+        while not self._stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            step = min(remaining, self.WAIT_SLICE)
+            if self._leases is not None:
+                job = self._leases.get(self._slot, timeout=0 if self._notifier else step)
+                if job:
+                    return True, job
+            if self._notifier:
+                # wake up early if the server announces new jobs
+                if self._notifier.wait(step):
+                    return True, None
+            elif self._leases is None:
+                time.sleep(step)
+        return False, None
+
+    def stop(self):
+        """
+        Stop taking new jobs and hand jobs we leased but did not start back to the server.
+        May be called from a signal handler.
+        """
+        self._stopping = True
+        if self._leases is not None:
+            threading.Thread(target=self._leases.return_all, args=(self._slot, self._conn)).start()